@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Compare XMLParser backends on a synthetic registry:
+#   bin/python benchmarks/xml_parser.py --docs 100000
+
+
+import os
+import random
+import argparse
+import tempfile
+
+from timeit import default_timer
+
+from openprocurement.medicines.registry.utils import XMLParser, ElementTreeBackend, LxmlBackend, etree
+
+
+DOC = (
+    '<doc><id>{id:032X}</id><title>{title}</title><form>{form}</form><mnn>{mnn}</mnn><mnntype></mnntype>'
+    '<fgroup>{fgroup}</fgroup><atc1>{atc1}</atc1><atc2>{atc2}</atc2><atc3>{atc3}</atc3><zt>{title}</zt>'
+    '<zc>Україна</zc><number>UA/{id}/01/01</number><begindate>19.12.2014</begindate><stop>Ні</stop></doc>\n'
+)
+
+
+def atc_code(rnd):
+    return '{}{:02d}{}{}{:02d}'.format(
+        rnd.choice('ABCDGHJLMNPRSV'), rnd.randint(1, 16), rnd.choice('ABCDEX'), rnd.choice('ABCDEX'), rnd.randint(1, 99)
+    )
+
+
+def generate_registry(file_path, docs, seed=0):
+    rnd = random.Random(seed)
+    inns = ['Inn{}{}'.format(i, '*' if i % 11 == 0 else '') for i in range(max(docs // 4, 1))]
+    atcs = [atc_code(rnd) for _ in range(max(docs // 6, 1))] + ['']
+
+    with open(file_path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="Windows-1251"?>\n<doc-list>\n')
+
+        for i in range(docs):
+            f.write(DOC.format(
+                id=i, title='ПРЕПАРАТ {}'.format(i), form='таблетки по {} мг'.format(rnd.randint(1, 500)),
+                mnn=rnd.choice(inns), fgroup='Група {}'.format(i % 50),
+                atc1=rnd.choice(atcs), atc2=rnd.choice(atcs), atc3=rnd.choice(atcs)
+            ))
+
+        f.write('</doc-list>\n')
+
+
+def measure(func, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = default_timer()
+        result = func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XMLParser backends benchmark')
+    parser.add_argument('--docs', type=int, default=50000, help='Number of <doc> items in synthetic registry')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+    params = parser.parse_args()
+
+    if etree is None:
+        print('lxml is not installed, nothing to compare.')
+        return
+
+    file_path = os.path.join(tempfile.mkdtemp(), 'registry.xml')
+    generate_registry(file_path, params.docs)
+    print('Synthetic registry: {} docs, {:.1f} MB'.format(params.docs, os.path.getsize(file_path) / 1024.0 / 1024))
+
+    with open(file_path, 'rb') as f:
+        xml = f.read()
+
+    results = dict()
+
+    for backend in (ElementTreeBackend, LxmlBackend):
+        cases = (
+            ('tree', lambda: XMLParser(xml, backend=backend).extract()),
+            ('stream', lambda: XMLParser(file_path, stream=True, backend=backend).extract()),
+        )
+
+        for mode, func in cases:
+            elapsed, result = measure(func, params.repeat)
+            results[(backend.name, mode)] = result
+            print('{:>6} {:>6}: {:.3f}s'.format(backend.name, mode, elapsed))
+
+    os.remove(file_path)
+    expected = results[(ElementTreeBackend.name, 'tree')]
+
+    if all(result == expected for result in results.values()):
+        print('All backends produced identical output.')
+    else:
+        print('Error! Backends output differs.')
+
+
+if __name__ == '__main__':
+    main()
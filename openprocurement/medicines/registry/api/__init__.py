@@ -3,10 +3,11 @@
 # API main entry point
 
 
+import os
 import logging.config
 import gevent.monkey
 
-from openprocurement.medicines.registry import VERSION
+from openprocurement.medicines.registry import VERSION, DATA_PATH
 from openprocurement.medicines.registry.api.utils import (
     Root,
     auth_check,
@@ -18,10 +19,16 @@ from openprocurement.medicines.registry.api.utils import (
     read_users
 )
 from openprocurement.medicines.registry.auth import authenticated_role
+from openprocurement.medicines.registry.databridge.caching import DB, SnapshotCache, SNAPSHOT_CHECK_INTERVAL
+from openprocurement.medicines.registry.databridge.indexes import IndexCache
+from openprocurement.medicines.registry.databridge.mapped_snapshot import (
+    MappedSnapshot, SNAPSHOT_FILE, MAPPED_CHECK_INTERVAL
+)
 
 gevent.monkey.patch_all()
 
 ROUTE_PREFIX = '/api/{}'.format(VERSION)
+VALID_PARAMS = ['inn', 'atc', 'inn2atc', 'atc2inn']
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +51,21 @@ def main(*args, **settings):
         route_prefix=ROUTE_PREFIX
     )
 
+    # one process-wide DB, its connection pool is shared by all requests
+    config.registry.db = DB(
+        {'app:api': settings}, readonly=str(settings.get('cache_read_from_replicas', '')).lower() == 'true'
+    )
+    config.registry.snapshots = SnapshotCache(
+        config.registry.db, VALID_PARAMS,
+        check_interval=int(settings.get('cache_snapshot_check_interval', SNAPSHOT_CHECK_INTERVAL))
+    )
+    # binary snapshot written by the bridge, mapped read-only and shared by all worker processes via page cache
+    config.registry.mapped = MappedSnapshot(
+        settings.get('snapshot_path') or os.path.join(DATA_PATH, SNAPSHOT_FILE),
+        check_interval=float(settings.get('snapshot_check_interval', MAPPED_CHECK_INTERVAL))
+    )
+    config.registry.indexes = IndexCache(config.registry.snapshots)
+
     config.include('pyramid_exclog')
     config.add_forbidden_view(forbidden)
     config.add_request_method(request_params, 'params', reify=True)
@@ -56,6 +78,12 @@ def main(*args, **settings):
     config.add_subscriber(set_renderer, NewRequest)
     config.add_route('health', '/health')
     config.add_route('registry', '/registry/{param}.json')
+    config.add_route('registry_inn', '/registry/inn/{name}')
+    config.add_route('registry_atc', '/registry/atc/{code}')
+    config.add_route('registry_atc_tree', '/registry/atc-tree/{code:[A-Za-z0-9]*}')
+    config.add_route('registry_autocomplete', '/registry/autocomplete')
+    config.add_route('registry_search', '/registry/search')
+    config.add_route('registry_lookup', '/registry/lookup')
     config.scan('openprocurement.medicines.registry.api.views')
     return config.make_wsgi_app()
 
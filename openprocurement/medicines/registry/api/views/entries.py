@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import logging.config
+
+from json import dumps
+from pyramid.view import view_defaults, view_config
+from pyramid.httpexceptions import exception_response
+
+from openprocurement.medicines.registry.api.utils import error_handler
+from openprocurement.medicines.registry.databridge.indexes import AtcTree, ATC_TREE_SECTION
+
+logger = logging.getLogger(__name__)
+
+BULK_LOOKUP_LIMIT = 10000
+
+
+def inn_key(value):
+    return value.strip().lower()
+
+
+def atc_key(value):
+    return value.strip().upper()
+
+
+# request field, dictionary, key normalization
+BULK_FIELDS = (
+    ('inn', 'inn2atc', inn_key),
+    ('atc', 'atc2inn', atc_key)
+)
+
+
+def validation_error(request, location, name, description):
+    response = exception_response(422)
+    response.body = dumps(error_handler(request, response.code, {
+        'location': location,
+        'name': name,
+        'description': description
+    }))
+    response.content_type = 'application/json'
+    return response
+
+
+@view_defaults(renderer='json', permission='registry')
+class EntriesView(object):
+    def __init__(self, request):
+        self.request = request
+        self.db = request.registry.db
+        self.mapped = request.registry.mapped
+
+    def lookup(self, keys):
+        # mapped snapshot first, pinned so that all dictionaries come from one generation, cache entries otherwise
+        mapped = self.mapped.pin()
+        entries = {name: mapped.lookup_many(name, name_keys) for name, name_keys in keys.items()}
+        missing = {name: keys[name] for name, name_entries in entries.items() if name_entries is None}
+
+        if not missing:
+            return mapped.generation, entries
+
+        # generation known to the process, so the entries are read in a single pipelined round-trip
+        generation = self.request.registry.snapshots.current_generation()
+
+        if generation is None:
+            entries.update({name: dict() for name in missing})
+        else:
+            entries.update(self.db.get_entries_multi(missing, generation))
+
+        return generation, entries
+
+    def entry(self, name, key, param, description):
+        generation, entries = self.lookup({name: [key]})
+        return self.found(generation, entries[name], key, param, description)
+
+    def found(self, generation, entries, key, param, description):
+        if generation is not None:
+            self.request.response.headers['X-Registry-Generation'] = str(generation)
+
+        if key not in entries:
+            return error_handler(self.request, 404, {
+                'location': 'url',
+                'name': param,
+                'description': description
+            })
+
+        return {'data': entries}
+
+    @view_config(route_name='registry_inn', request_method='GET')
+    def inn(self):
+        return self.entry('inn2atc', inn_key(self.request.matchdict['name']), 'name', 'INN not found')
+
+    @view_config(route_name='registry_atc', request_method='GET')
+    def atc(self):
+        return self.entry('atc2inn', atc_key(self.request.matchdict['code']), 'code', 'ATC code not found')
+
+    @view_config(route_name='registry_atc_tree', request_method='GET')
+    def atc_tree(self):
+        code = atc_key(self.request.matchdict['code'])
+
+        # tree written by the bridge into the mapped snapshot, in-process tree over the cache otherwise
+        mapped = self.mapped.pin()
+        nodes = mapped.lookup_many(ATC_TREE_SECTION, [code])
+        generation = mapped.generation
+
+        if nodes is None:
+            generation, tree = self.request.registry.indexes.get(('atc2inn', 'atc'), AtcTree)
+            nodes = tree.lookup_many([code]) if tree is not None else {}
+
+        return self.found(generation, nodes, code, 'code', 'ATC code not found')
+
+    def bulk_keys(self):
+        if self.request.content_type == 'application/json':
+            try:
+                data = self.request.json_body.get('data')
+            except (ValueError, AttributeError):
+                data = None
+        else:
+            data = {field: self.request.params.getall(field) for field, _, _ in BULK_FIELDS}
+
+        if not isinstance(data, dict):
+            raise validation_error(self.request, 'body', 'data', 'Data not available')
+
+        keys = dict()
+
+        for field, name, normalize in BULK_FIELDS:
+            values = data.get(field) or []
+
+            if not isinstance(values, list) or not all(isinstance(v, basestring) for v in values):
+                raise validation_error(self.request, 'body', field, 'Must be a list of strings')
+
+            keys[name] = list(set(normalize(v) for v in values))
+
+        total = sum(len(v) for v in keys.values())
+
+        if not total:
+            raise validation_error(self.request, 'body', 'data', 'At least one of "inn" or "atc" is required')
+        elif total > BULK_LOOKUP_LIMIT:
+            raise validation_error(
+                self.request, 'body', 'data', 'At most {} items are allowed, got {}'.format(BULK_LOOKUP_LIMIT, total)
+            )
+
+        return keys
+
+    @view_config(route_name='registry_lookup', request_method='POST')
+    def bulk(self):
+        keys = self.bulk_keys()
+        generation, entries = self.lookup(keys)
+
+        if generation is not None:
+            self.request.response.headers['X-Registry-Generation'] = str(generation)
+
+        return {
+            'data': {field: entries[name] for field, name, _ in BULK_FIELDS},
+            'missing': {field: sorted(set(keys[name]) - set(entries[name])) for field, name, _ in BULK_FIELDS}
+        }
@@ -4,9 +4,10 @@ import logging.config
 
 from pyramid.view import view_defaults, view_config
 from pyramid.response import FileResponse, Response
-from openprocurement.medicines.registry.databridge.caching import DB
 from openprocurement.medicines.registry import BASE_DIR
-from openprocurement.medicines.registry.utils import str_to_obj, journal_context
+from openprocurement.medicines.registry.api import VALID_PARAMS
+from openprocurement.medicines.registry.databridge.mapped_snapshot import MappedBody
+from openprocurement.medicines.registry.utils import journal_context
 from openprocurement.medicines.registry.journal_msg_ids import API_INFO
 
 logger = logging.getLogger(__name__)
@@ -17,44 +18,50 @@ class RegistryView(object):
     def __init__(self, request):
         self.request = request
         self.DATA_PATH = os.path.join(BASE_DIR, 'data')
+        self.snapshots = self.request.registry.snapshots
+        self.mapped = self.request.registry.mapped
 
-        db_config = {'app:api': {
-            'cache_host': self.request.registry.settings.get('cache_host'),
-            'cache_port': self.request.registry.settings.get('cache_port'),
-            'cache_db_name': self.request.registry.settings.get('cache_db_name'),
-            'cache_backend': self.request.registry.settings.get('cache_backend'),
-
-            'node1_host': self.request.registry.settings.get('node1_host'),
-            'node1_port': self.request.registry.settings.get('node1_port'),
-            'node2_host': self.request.registry.settings.get('node2_host'),
-            'node2_port': self.request.registry.settings.get('node2_port'),
-            'node3_host': self.request.registry.settings.get('node3_host'),
-            'node3_port': self.request.registry.settings.get('node3_port'),
-            'node4_host': self.request.registry.settings.get('node4_host'),
-            'node4_port': self.request.registry.settings.get('node4_port'),
-            'node5_host': self.request.registry.settings.get('node5_host'),
-            'node5_port': self.request.registry.settings.get('node5_port'),
-            'node6_host': self.request.registry.settings.get('node6_host'),
-            'node6_port': self.request.registry.settings.get('node6_port')
-        }}
-        self.db = DB(db_config)
-
-        self.valid_params = ['inn', 'atc', 'inn2atc', 'atc2inn']
+        self.valid_params = VALID_PARAMS
+
+    def accepts_gzip(self):
+        # without the header WebOb treats any encoding as acceptable, gzip is only sent to clients asking for it
+        if 'Accept-Encoding' not in self.request.headers:
+            return False
+
+        return self.request.accept_encoding.best_match(['gzip', 'identity']) == 'gzip'
 
     @view_config(request_method='GET', permission='registry')
     def get(self):
         param = self.request.matchdict.get('param')
 
         if param in self.valid_params:
-            try:
-                data = str_to_obj(self.db.get(param))
-            except ValueError:
-                data = None
-                logger.warn('Cache is empty!', extra=journal_context({'MESSAGE_ID': API_INFO}, {}))
+            generation, snapshot = self.mapped.get(param)
+
+            if snapshot is None:
+                try:
+                    generation, snapshot = self.snapshots.get(param)
+                except (ValueError, SyntaxError):
+                    generation, snapshot = None, None
+
+            if snapshot and snapshot.body:
+                gzip = snapshot.gzip and self.accepts_gzip()
+                body = snapshot.gzip if gzip else snapshot.body
 
-            if data:
-                response = Response(body=json.dumps(data), content_type='application/json', status=200)
+                # bodies of the mapped snapshot are streamed from the mapping
+                response = Response(
+                    app_iter=body if isinstance(body, MappedBody) else [body], content_length=len(body),
+                    content_type='application/json', status=200
+                )
+
+                if gzip:
+                    response.content_encoding = 'gzip'
+
+                response.vary = 'Accept-Encoding'
+
+                if generation is not None:
+                    response.headers['X-Registry-Generation'] = str(generation)
             else:
+                logger.warn('Cache is empty!', extra=journal_context({'MESSAGE_ID': API_INFO}, {}))
                 file_path = os.path.join(self.DATA_PATH, '{}.json'.format(param))
                 response = FileResponse(path=file_path, request=self.request, content_type='application/json')
         else:
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import logging.config
+
+from pyramid.view import view_defaults, view_config
+
+from openprocurement.medicines.registry.api.views.entries import inn_key, validation_error
+from openprocurement.medicines.registry.databridge.indexes import (
+    PrefixIndex, TrigramIndex, TRIGRAMS_SECTION, trigrams, rank
+)
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 100
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_QUERY = 100
+
+
+@view_defaults(renderer='json', permission='registry')
+class SearchView(object):
+    def __init__(self, request):
+        self.request = request
+        self.mapped = request.registry.mapped
+        self.indexes = request.registry.indexes
+
+    def query(self):
+        query = inn_key(self.request.params.get('q', ''))
+
+        if not query:
+            raise validation_error(self.request, 'url', 'q', 'Query is required')
+
+        return query
+
+    def limit(self, default, maximum):
+        try:
+            limit = int(self.request.params.get('limit', default))
+        except ValueError:
+            limit = 0
+
+        if not 0 < limit <= maximum:
+            raise validation_error(self.request, 'url', 'limit', 'Must be an integer from 1 to {}'.format(maximum))
+
+        return limit
+
+    def set_generation(self, generation):
+        if generation is not None:
+            self.request.response.headers['X-Registry-Generation'] = str(generation)
+
+    @view_config(route_name='registry_autocomplete', request_method='GET')
+    def autocomplete(self):
+        query, limit = self.query(), self.limit(AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT)
+
+        # binary search over the sorted keys of the mapped snapshot, in-process index over the cache otherwise
+        mapped = self.mapped.pin()
+        entries = mapped.prefix('inn', query, limit)
+        generation = mapped.generation
+
+        if entries is None:
+            generation, index = self.indexes.get('inn', PrefixIndex)
+            entries = index.prefix(query, limit) if index is not None else []
+
+        self.set_generation(generation)
+        return {'data': [{'inn': key, 'name': name} for key, name in entries]}
+
+    @view_config(route_name='registry_search', request_method='GET')
+    def search(self):
+        query, limit = self.query()[:SEARCH_MAX_QUERY], self.limit(SEARCH_LIMIT, SEARCH_MAX_LIMIT)
+        query_trigrams = list(trigrams(query))
+
+        # trigram postings of the mapped snapshot, in-process index over the cache otherwise. Postings and names are
+        # read from one pinned mapping, a re-mapping in between would pair them across generations
+        mapped = self.mapped.pin()
+        postings = mapped.lookup_many(TRIGRAMS_SECTION, query_trigrams)
+        generation = mapped.generation
+
+        if postings is not None:
+            results = rank(query, postings, limit)
+            names = mapped.lookup_many('inn', [key for _, key in results]) or {}
+        else:
+            generation, index = self.indexes.get('inn', TrigramIndex)
+            results = rank(query, index.lookup_many(query_trigrams), limit) if index is not None else []
+            names = index.entries if index is not None else {}
+
+        self.set_generation(generation)
+        return {'data': [{'inn': key, 'name': names.get(key), 'score': round(score, 3)} for score, key in results]}
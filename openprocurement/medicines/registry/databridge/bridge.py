@@ -18,7 +18,9 @@ from openprocurement.medicines.registry.journal_msg_ids import (
 )
 from openprocurement.medicines.registry.databridge.caching import DB
 from openprocurement.medicines.registry import BASE_DIR
-from openprocurement.medicines.registry.databridge.components import Registry, JsonFormer
+from openprocurement.medicines.registry.databridge.components import (
+    Registry, JsonFormer, CONNECT_TIMEOUT, READ_TIMEOUT, DOWNLOAD_RETRIES
+)
 from openprocurement.medicines.registry.client import ProxyClient
 
 
@@ -59,6 +61,12 @@ class MedicinesRegistryBridge(object):
         except (NoOptionError, KeyError):
             self.source_registry_proxy = None
 
+        self.connect_timeout = int(self.config_get_default('connect_timeout', CONNECT_TIMEOUT))
+        self.read_timeout = int(self.config_get_default('read_timeout', READ_TIMEOUT))
+        self.download_retries = int(self.config_get_default('download_retries', DOWNLOAD_RETRIES))
+        self.extract_in_subprocess = str(self.config_get_default('extract_in_subprocess', False)).lower() == 'true'
+        self.snapshot_path = self.config_get_default('snapshot_path')
+
         self._files_init()
 
         self.proxy_client = ProxyClient(
@@ -74,6 +82,10 @@ class MedicinesRegistryBridge(object):
             Registry.spawn,
             source_registry=self.source_registry,
             source_registry_proxy=self.source_registry_proxy,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            download_retries=self.download_retries,
+            extract_in_subprocess=self.extract_in_subprocess,
             time_update_at=self.time_update_at,
             delay=self.delay,
             registry_delay=self.registry_delay,
@@ -85,7 +97,9 @@ class MedicinesRegistryBridge(object):
             delay=self.delay,
             json_files_delay=self.json_files_delay,
             cache_monitoring_delay=self.cache_monitoring_delay,
-            services_not_available=self.services_not_available
+            services_not_available=self.services_not_available,
+            extract_in_subprocess=self.extract_in_subprocess,
+            snapshot_path=self.snapshot_path
         )
 
         self.sandbox_mode = os.environ.get('SANDBOX_MODE', 'False')
@@ -96,6 +110,14 @@ class MedicinesRegistryBridge(object):
         else:
             return self.config.get(name)
 
+    def config_get_default(self, name, default=None):
+        try:
+            value = self.config_get(name)
+        except (NoOptionError, KeyError):
+            value = None
+
+        return default if value is None else value
+
     def _files_init(self):
         self.DATA_PATH = os.path.join(self.BASE_DIR, 'data')
 
@@ -1,55 +1,186 @@
+import os
+import json
+import zlib
 import logging
 import redis
-from ConfigParser import ConfigParser
+import gevent
+
+from collections import namedtuple
+from gevent.lock import Semaphore
+from time import time
+from ConfigParser import ConfigParser, NoOptionError
 
 from rediscluster import StrictRedisCluster
 
+from openprocurement.medicines.registry.utils import str_to_obj, journal_context, to_unicode
+from openprocurement.medicines.registry.journal_msg_ids import API_CACHE
+from openprocurement.medicines.registry.databridge.local_store import LocalStore, LOCAL_POLL_INTERVAL
+from openprocurement.medicines.registry import DATA_PATH
+
 
 logger = logging.getLogger(__name__)
 
+# One DB is shared by the whole process, so its connection pool is bounded and blocks (greenlet-safe) when exhausted
+CACHE_MAX_CONNECTIONS = 50
+
+# Cached payloads are stored as '<version>:<body>', so the encoding can change without breaking readers.
+# Values without a known header are legacy str(dict) entries.
+PAYLOAD_JSON = 'j1:'
+
+# With cache_compression_level set (1-9) payloads are stored gzip compressed, the API sends them to clients as-is
+PAYLOAD_GZIP = 'z1:'
+
+# Large payloads are split into '<name>:<gen>:chunk:<i>' keys, the payload key then holds a 'c1:<count>' manifest.
+# Chunk keys hash to different slots, so on a cluster no single node serves a whole multi-megabyte dictionary.
+PAYLOAD_CHUNKED = 'c1:'
+PAYLOAD_CHUNK_SIZE = 256 * 1024
+
+# Dictionaries are also stored entry by entry in hashes, loaded in pipelined batches. Entries are spread over
+# ENTRIES_BUCKETS hashes by crc32 of the entry key for the same reason.
+ENTRIES_BATCH = 1000
+ENTRIES_BUCKETS = 16
+
+# By default the full payload is stored next to the hashes, so it is served exactly as published (serialized and
+# compressed once by the bridge) at the cost of keeping every dictionary twice. With cache_store_payloads = false
+# the payload key holds only 'h1:<json of entries count and the value without data>', and readers rebuild the
+# payload from the hashes (once per generation in the API snapshot cache).
+PAYLOAD_HASHED = 'h1:'
+
+# Every publish writes a new generation of all dictionaries ('<name>:<gen>' payload and '<name>:<gen>:entries:*' hashes)
+# and then switches the shared generation pointer with a single SET, so readers never see a missing, partial or
+# mixed set of dictionaries. Superseded generations are left to expire after a grace period for in-flight readers.
+GENERATION_KEY = 'registry:generation'
+SEQUENCE_KEY = 'registry:sequence'
+GENERATION_GRACE = 300
+
+# The bridge re-stamps TTLs of the published generation once it is about to expire, so a skipped registry refresh
+# never lets live keys expire. Only superseded generations are left to expire.
+CACHE_REFRESH_AHEAD = 3600
+
+SCAN_COUNT = 1000
+
+# Every switch of the generation pointer is announced on this channel, API workers drop their snapshots on it
+GENERATION_CHANNEL = 'registry:generation:changed'
+SNAPSHOT_CHECK_INTERVAL = 60
+SNAPSHOT_RESUBSCRIBE_DELAY = 5
+
+
+def payload_key(name, generation):
+    return '{}:{}'.format(name, generation)
+
+
+def chunk_key(name, generation, chunk):
+    return '{}:{}:chunk:{}'.format(name, generation, chunk)
+
+
+def entries_key(name, generation, bucket):
+    return '{}:{}:entries:{}'.format(name, generation, bucket)
+
+
+def entries_bucket(key):
+    return (zlib.crc32(to_unicode(key).encode('utf-8')) & 0xffffffff) % ENTRIES_BUCKETS
+
+
+def payload_chunks(payload):
+    if payload is not None and payload.startswith(PAYLOAD_CHUNKED):
+        return int(payload[len(PAYLOAD_CHUNKED):])
+
+
+def encode_payload(value, compression_level=0):
+    body = json.dumps(value, separators=(',', ':'))
+
+    if not compression_level:
+        return PAYLOAD_JSON + body
+
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return PAYLOAD_GZIP + compressor.compress(body) + compressor.flush()
+
+
+def payload_body(payload):
+    if payload is None:
+        return None
+
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+
+    if payload.startswith(PAYLOAD_JSON):
+        return payload[len(PAYLOAD_JSON):]
+
+    if payload.startswith(PAYLOAD_GZIP):
+        return zlib.decompress(payload[len(PAYLOAD_GZIP):], 16 + zlib.MAX_WBITS)
+
+    return json.dumps(str_to_obj(payload))
+
+
+def payload_gzip(payload):
+    if payload is not None and payload.startswith(PAYLOAD_GZIP):
+        return payload[len(PAYLOAD_GZIP):]
+
+
+def decode_payload(payload):
+    body = payload_body(payload)
+
+    if body is not None:
+        return json.loads(body)
+
 
 class DB(object):
-    def __init__(self, config):
+    def __init__(self, config, readonly=False):
         self.config = config
         cache_backend = self.config_get('cache_backend') or 'redis'
 
+        self.compression_level = int(self.config_get_default('cache_compression_level', 0))
+        self.store_payloads = str(self.config_get_default('cache_store_payloads', 'true')).lower() == 'true'
+        max_connections = int(self.config_get_default('cache_max_connections', CACHE_MAX_CONNECTIONS))
+        socket_options = dict(
+            socket_timeout=self.config_get_float('cache_socket_timeout'),
+            socket_connect_timeout=self.config_get_float('cache_socket_connect_timeout')
+        )
+        # pub/sub blocks until a message arrives, its client must not inherit cache_socket_timeout
+        subscriber_options = dict(socket_options, socket_timeout=None)
+
         if cache_backend == 'redis':
             self.__backend = cache_backend
             self.__host = self.config_get('cache_host') or '127.0.0.1'
             self.__port = self.config_get('cache_port') or 6379
             self.__db_name = self.config_get('cache_db_name') or 0
 
-            self.db = redis.StrictRedis(host=self.__host, port=self.__port, db=self.__db_name)
+            pool = redis.BlockingConnectionPool(
+                host=self.__host, port=self.__port, db=self.__db_name, max_connections=max_connections,
+                **socket_options
+            )
+            self.db = redis.StrictRedis(connection_pool=pool)
+            self.subscriber = lambda: redis.StrictRedis(
+                host=self.__host, port=self.__port, db=self.__db_name, **subscriber_options
+            )
         elif cache_backend == 'redis-cluster':
             self.__backend = cache_backend
-            node1_host = self.config_get('node1_host')
-            node1_port = self.config_get('node1_port')
-            node2_host = self.config_get('node2_host')
-            node2_port = self.config_get('node2_port')
-            node3_host = self.config_get('node3_host')
-            node3_port = self.config_get('node3_port')
-
-            node4_host = self.config_get('node4_host')
-            node4_port = self.config_get('node4_port')
-            node5_host = self.config_get('node5_host')
-            node5_port = self.config_get('node5_port')
-            node6_host = self.config_get('node6_host')
-            node6_port = self.config_get('node6_port')
-
-            self.__host = (node1_host, node2_host, node3_host, node4_host, node5_host, node6_host)
-            self.__port = (node1_port, node2_port, node3_port, node4_port, node5_port, node6_port)
+            cluster_nodes = self.cluster_nodes()
+
+            self.__host = tuple(node['host'] for node in cluster_nodes)
+            self.__port = tuple(node['port'] for node in cluster_nodes)
             self.__db_name = 'cluster'
 
-            cluster_nodes = [
-                {'host': node1_host, 'port': node1_port},
-                {'host': node2_host, 'port': node2_port},
-                {'host': node3_host, 'port': node3_port},
-                {'host': node4_host, 'port': node4_port},
-                {'host': node5_host, 'port': node5_port},
-                {'host': node6_host, 'port': node6_port}
-            ]
+            # readonly mode sends commands to replicas as well, only for clients that never write.
+            # Responses are not decoded, compressed payloads are binary.
+            self.db = StrictRedisCluster(
+                startup_nodes=cluster_nodes, decode_responses=False, max_connections=max_connections,
+                readonly_mode=readonly, **socket_options
+            )
+            self.subscriber = lambda: StrictRedisCluster(
+                startup_nodes=cluster_nodes, decode_responses=False, **subscriber_options
+            )
 
-            self.db = StrictRedisCluster(startup_nodes=cluster_nodes, decode_responses=True)
+        elif cache_backend == 'local':
+            self.__backend = cache_backend
+            self.__host = None
+            self.__port = None
+            self.__db_name = self.config_get_default('cache_path') or os.path.join(DATA_PATH, 'cache')
+
+            self.db = LocalStore(
+                self.__db_name, poll_interval=float(self.config_get_default('cache_poll_interval', LOCAL_POLL_INTERVAL))
+            )
+            self.subscriber = lambda: self.db
 
         self.set_value = self.db.set
         self.has_value = self.db.exists
@@ -59,18 +190,257 @@ class DB(object):
         if isinstance(self.config, ConfigParser):
             return self.config.get('app:api', name)
         else:
-            return self.config.get('app:api').get(name)
+            # the bridge passes its flat settings dict
+            return self.config.get('app:api', self.config).get(name)
+
+    def config_get_default(self, name, default=None):
+        try:
+            value = self.config_get(name)
+        except NoOptionError:
+            value = None
+
+        return default if value is None else value
+
+    def config_get_float(self, name):
+        value = self.config_get_default(name)
+
+        if value is not None:
+            return float(value)
+
+    def cluster_nodes(self):
+        cache_nodes = self.config_get_default('cache_nodes')
+
+        if cache_nodes:
+            nodes = [node.rsplit(':', 1) for node in cache_nodes.replace(',', ' ').split()]
+            return [{'host': host, 'port': port} for host, port in nodes]
+
+        # legacy node1_host/node1_port, node2_host/node2_port, ... settings
+        nodes = list()
+
+        while self.config_get_default('node{}_host'.format(len(nodes) + 1)):
+            number = len(nodes) + 1
+            nodes.append({
+                'host': self.config_get('node{}_host'.format(number)),
+                'port': self.config_get('node{}_port'.format(number))
+            })
+
+        return nodes
 
     def get(self, key):
         return self.db.get(key)
 
     def keys(self, prefix):
-        keys = self.db.keys(prefix)
-        return keys
+        return self.scan_iter(prefix)
 
     def put(self, key, value, ex=90000):
         self.set_value(key, value, ex)
 
+    def generation(self):
+        generation = self.get(GENERATION_KEY)
+
+        if generation is not None:
+            return int(generation)
+
+    def generation_ttl(self):
+        return self.db.ttl(GENERATION_KEY)
+
+    def published(self, name, generation=None):
+        if generation is None:
+            generation = self.generation()
+
+        return generation is not None and bool(self.has(payload_key(name, generation)))
+
+    def get_payload(self, name, generation=None):
+        return decode_payload(self.get_published(name, generation))
+
+    def get_payload_body(self, name, generation=None):
+        return payload_body(self.get_published(name, generation))
+
+    def get_published(self, name, generation=None):
+        if generation is None:
+            generation = self.generation()
+
+        if generation is None:
+            return self.get(name)
+
+        payload = self.get(payload_key(name, generation))
+
+        if payload is not None and payload.startswith(PAYLOAD_HASHED):
+            return self.get_hashed(name, generation, payload)
+
+        chunks = payload_chunks(payload)
+
+        if chunks is None:
+            return payload
+
+        pipe = self.db.pipeline(transaction=False)
+
+        for chunk in range(chunks):
+            pipe.get(chunk_key(name, generation, chunk))
+
+        values = pipe.execute()
+
+        if None not in values:
+            return ''.join(values)
+
+    def get_hashed(self, name, generation, payload):
+        header = json.loads(payload[len(PAYLOAD_HASHED):])
+        pipe = self.db.pipeline(transaction=False)
+
+        for bucket in range(ENTRIES_BUCKETS):
+            pipe.hgetall(entries_key(name, generation, bucket))
+
+        data = dict()
+
+        for fields in pipe.execute():
+            data.update((to_unicode(k), json.loads(v)) for k, v in fields.items())
+
+        # some buckets are not there (yet) on this node, the payload is treated as not published
+        if len(data) != header['count']:
+            return None
+
+        return encode_payload(dict(header['value'], data=data), self.compression_level)
+
+    def put_payload(self, key, value, ex=90000):
+        self.put(key, encode_payload(value), ex)
+
+    def put_published(self, name, generation, value, ex=90000):
+        if not self.store_payloads:
+            header = {'count': len(value.get('data') or {}), 'value': {k: v for k, v in value.items() if k != 'data'}}
+            self.put(payload_key(name, generation), PAYLOAD_HASHED + json.dumps(header, separators=(',', ':')), ex)
+            return
+
+        payload = encode_payload(value, self.compression_level)
+
+        if len(payload) > PAYLOAD_CHUNK_SIZE:
+            chunks = [payload[i:i + PAYLOAD_CHUNK_SIZE] for i in range(0, len(payload), PAYLOAD_CHUNK_SIZE)]
+            pipe = self.db.pipeline(transaction=False)
+
+            for chunk, data in enumerate(chunks):
+                pipe.set(chunk_key(name, generation, chunk), data, ex)
+
+            pipe.execute()
+            payload = PAYLOAD_CHUNKED + str(len(chunks))
+
+        self.put(payload_key(name, generation), payload, ex)
+
+    def get_entry(self, name, key, generation=None):
+        if generation is None:
+            generation = self.generation()
+
+        if generation is None:
+            return None
+
+        value = self.db.hget(entries_key(name, generation, entries_bucket(key)), key)
+
+        if value is not None:
+            return json.loads(value)
+
+    def get_entries(self, name, keys, generation=None):
+        return self.get_entries_multi({name: keys}, generation).get(name, dict())
+
+    def get_entries_multi(self, keys, generation=None):
+        # {name: [key, ...]} -> {name: {key: value}}, every dictionary in one pipelined round-trip
+        buckets = dict()
+
+        for name, name_keys in keys.items():
+            for key in name_keys:
+                buckets.setdefault((name, entries_bucket(key)), list()).append(key)
+
+        if generation is None:
+            generation = self.generation()
+
+        entries = {name: dict() for name in keys}
+
+        if not buckets or generation is None:
+            return entries
+
+        pipe = self.db.pipeline(transaction=False)
+
+        for (name, bucket), bucket_keys in buckets.items():
+            pipe.hmget(entries_key(name, generation, bucket), bucket_keys)
+
+        for ((name, _), bucket_keys), values in zip(buckets.items(), pipe.execute()):
+            entries[name].update({k: json.loads(v) for k, v in zip(bucket_keys, values) if v is not None})
+
+        return entries
+
+    def put_entries(self, name, generation, entries, ex=90000):
+        buckets = dict()
+
+        for key, value in entries.items():
+            buckets.setdefault(entries_bucket(key), dict())[key] = json.dumps(value, separators=(',', ':'))
+
+        pipe = self.db.pipeline(transaction=False)
+
+        for bucket, fields in buckets.items():
+            key = entries_key(name, generation, bucket)
+            items = fields.items()
+
+            for i in range(0, len(items), ENTRIES_BATCH):
+                pipe.hmset(key, dict(items[i:i + ENTRIES_BATCH]))
+                pipe.execute()
+
+            pipe.expire(key, ex)
+
+        pipe.execute()
+
+    def generation_keys(self, name, generation):
+        keys = [payload_key(name, generation)]
+        keys.extend(entries_key(name, generation, bucket) for bucket in range(ENTRIES_BUCKETS))
+        chunks = payload_chunks(self.get(payload_key(name, generation)))
+
+        if chunks is not None:
+            keys.extend(chunk_key(name, generation, chunk) for chunk in range(chunks))
+
+        return keys
+
+    def expire_generation(self, names, generation, ex):
+        pipe = self.db.pipeline(transaction=False)
+
+        for name in names:
+            for key in self.generation_keys(name, generation):
+                pipe.expire(key, ex)
+
+        pipe.execute()
+
+    def publish(self, values, ex=90000):
+        previous = self.generation()
+        generation = self.db.incr(SEQUENCE_KEY)
+
+        # data keys outlive the pointer, so a published generation never points to expired data
+        for name, value in values.items():
+            self.put_published(name, generation, value, ex + GENERATION_GRACE)
+            self.put_entries(name, generation, value.get('data') or {}, ex + GENERATION_GRACE)
+
+        self.put(GENERATION_KEY, generation, ex)
+        self.db.publish(GENERATION_CHANNEL, generation)
+
+        if previous is not None and previous != generation:
+            self.expire_generation(values, previous, GENERATION_GRACE)
+
+        # the local store only drops expired keys on access, generations past their grace period are reaped here
+        if self.backend == 'local':
+            self.db.purge()
+
+        return generation
+
+    def subscribe(self, channel):
+        pubsub = self.subscriber().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return pubsub
+
+    def touch(self, names, ex=90000):
+        generation = self.generation()
+
+        if generation is None:
+            return None
+
+        self.expire_generation(names, generation, ex + GENERATION_GRACE)
+        self.db.expire(GENERATION_KEY, ex)
+
+        return generation
+
     def remove(self, key):
         self.remove_value(key)
 
@@ -78,10 +448,10 @@ class DB(object):
         return self.has_value(key)
 
     def scan_iter(self, prefix=None):
-        return [key for key in self.db.scan_iter(prefix)]
+        return [key for key in self.db.scan_iter(prefix, count=SCAN_COUNT)]
 
     def remove_pattern(self, prefix):
-        for key in self.db.scan_iter(prefix):
+        for key in self.db.scan_iter(prefix, count=SCAN_COUNT):
             self.remove(key)
 
     def flushall(self):
@@ -102,3 +472,102 @@ class DB(object):
     @property
     def db_name(self):
         return self.__db_name
+
+
+Snapshot = namedtuple('Snapshot', ['body', 'gzip'])
+
+
+class SnapshotCache(object):
+    def __init__(self, db, names, check_interval=SNAPSHOT_CHECK_INTERVAL):
+        self.db = db
+        self.names = names
+        self.check_interval = check_interval
+        self.generation = None
+        self.snapshots = dict()
+        self.checked_at = None
+        self.pointer = None
+        self.pointer_checked_at = None
+        self.listener = None
+        self.lock = Semaphore()
+
+    def get(self, name):
+        if self.listener is None:
+            self.listener = gevent.spawn(self.listen)
+
+        if self.stale():
+            with self.lock:
+                if self.stale():
+                    self.reload()
+
+        return self.generation, self.snapshots.get(name)
+
+    def current_generation(self):
+        # published generation without loading payloads, the pointer is re-read at most once per check interval
+        if self.listener is None:
+            self.listener = gevent.spawn(self.listen)
+
+        if not self.stale():
+            return self.generation
+
+        if self.pointer_checked_at is None or time() - self.pointer_checked_at >= self.check_interval:
+            self.pointer = self.db.generation()
+            self.pointer_checked_at = time() if self.pointer is not None else None
+
+        return self.pointer
+
+    def stale(self):
+        return self.checked_at is None or time() - self.checked_at >= self.check_interval
+
+    def invalidate(self):
+        self.checked_at = None
+        self.pointer_checked_at = None
+
+    def load(self, name, generation):
+        payload = self.db.get_published(name, generation)
+        return Snapshot(payload_body(payload), payload_gzip(payload)) if payload else None
+
+    def reload(self):
+        generation = self.db.generation()
+
+        if generation is None or generation != self.generation:
+            snapshots = {name: self.load(name, generation) for name in self.names}
+
+            # with reads from replicas a new generation may be visible before all of its keys are replicated
+            if generation is not None and any(snapshots[n] is None and self.snapshots.get(n) for n in self.names):
+                self.checked_at = None
+                return
+
+            self.snapshots = snapshots
+            self.generation = generation
+
+            logger.info(
+                'Cache snapshot loaded. Generation {}.'.format(generation),
+                extra=journal_context({'MESSAGE_ID': API_CACHE}, {})
+            )
+        else:
+            for name in self.names:
+                if self.snapshots.get(name) is None:
+                    self.snapshots[name] = self.load(name, generation)
+
+        # nothing is published yet or a payload is still missing (not replicated yet), check again on the next request
+        missing = any(self.snapshots.get(name) is None for name in self.names)
+        self.checked_at = time() if generation is not None and not missing else None
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.db.subscribe(GENERATION_CHANNEL)
+
+                # messages published before the subscription are lost
+                if self.db.generation() != self.generation:
+                    self.invalidate()
+
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except redis.RedisError as e:
+                logger.warn(
+                    'Cache snapshot subscription error: {}'.format(e),
+                    extra=journal_context({'MESSAGE_ID': API_CACHE}, {})
+                )
+
+            gevent.sleep(SNAPSHOT_RESUBSCRIBE_DELAY)
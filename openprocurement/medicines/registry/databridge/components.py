@@ -1,11 +1,16 @@
 import os
+import codecs
+import hashlib
 import logging.config
+import socket
 import gevent
 import json
-from urllib2 import urlopen, ProxyHandler, build_opener
+from urllib2 import urlopen, ProxyHandler, Request, URLError, HTTPError, build_opener
+from httplib import HTTPException
 
 from datetime import timedelta
 from gevent import spawn, monkey
+from retrying import Retrying
 from openprocurement.medicines.registry.journal_msg_ids import (
     BRIDGE_INFO,
     BRIDGE_REGISTER,
@@ -14,8 +19,13 @@ from openprocurement.medicines.registry.journal_msg_ids import (
     BRIDGE_CACHE
 )
 from openprocurement.medicines.registry.utils import (
-    journal_context, decode_cp1251, get_now, get_file_last_modified, file_is_empty, XMLParser, string_time_to_datetime
+    journal_context, get_now, get_file_last_modified, file_is_empty, file_exists, string_time_to_datetime,
+    xml_file_valid, CHUNK_SIZE
 )
+from openprocurement.medicines.registry.databridge.extractor import extract_values, run_in_subprocess
+from openprocurement.medicines.registry.databridge.caching import CACHE_REFRESH_AHEAD
+from openprocurement.medicines.registry.databridge.mapped_snapshot import write_snapshot, SNAPSHOT_FILE
+from openprocurement.medicines.registry.databridge.indexes import search_indexes
 from openprocurement.medicines.registry import DATA_PATH
 from openprocurement.medicines.registry.databridge.base_worker import BaseWorker
 
@@ -23,9 +33,24 @@ from openprocurement.medicines.registry.databridge.base_worker import BaseWorker
 monkey.patch_all()
 logger = logging.getLogger(__name__)
 
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_MULT = 1000
+DOWNLOAD_RETRY_MAX = 60 * 1000
+
+
+def retry_download(exception):
+    if isinstance(exception, HTTPError):
+        return exception.code >= 500
+
+    return isinstance(exception, (URLError, HTTPException, socket.error))
+
 
 class Registry(BaseWorker):
-    def __init__(self, source_registry, time_update_at, delay, registry_delay, services_not_available, source_registry_proxy=None):
+    def __init__(self, source_registry, time_update_at, delay, registry_delay, services_not_available,
+                 source_registry_proxy=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 download_retries=DOWNLOAD_RETRIES, extract_in_subprocess=False):
         super(Registry, self).__init__(services_not_available)
         self.start_time = get_now()
 
@@ -43,6 +68,17 @@ class Registry(BaseWorker):
 
         self.delay = delay
         self.registry_delay = registry_delay
+        self.chunk_size = CHUNK_SIZE
+        self.extract_in_subprocess = extract_in_subprocess
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retrying = Retrying(
+            stop_max_attempt_number=download_retries,
+            wait_exponential_multiplier=DOWNLOAD_RETRY_MULT,
+            wait_exponential_max=DOWNLOAD_RETRY_MAX,
+            wait_jitter_max=DOWNLOAD_RETRY_MULT,
+            retry_on_exception=retry_download
+        )
 
         if source_registry_proxy:
             proxy = ProxyHandler({'http': source_registry_proxy, 'https': source_registry_proxy})
@@ -50,53 +86,232 @@ class Registry(BaseWorker):
         else:
             self.urlopen = urlopen
 
-    def save_registry(self, xml):
+    def read_registry_meta(self):
+        file_path = os.path.join(self.DATA_PATH, 'registry.meta')
+
+        if not file_exists(file_path) or file_is_empty(file_path):
+            return dict()
+
+        with open(file_path, 'r') as f:
+            try:
+                return json.loads(f.read())
+            except ValueError:
+                return dict()
+
+    def save_registry_meta(self, meta):
+        with open(os.path.join(self.DATA_PATH, 'registry.meta'), 'w') as f:
+            f.write(json.dumps(meta))
+
+    def registry_request(self):
+        request = Request(self.source_registry)
+        registry_xml = os.path.join(self.DATA_PATH, 'registry.xml')
+
+        if file_exists(registry_xml) and not file_is_empty(registry_xml):
+            meta = self.read_registry_meta()
+
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        return request
+
+    def read_download_state(self, file_path):
+        state_path = '{}.state'.format(file_path)
+
+        if not file_exists(file_path) or not file_exists(state_path):
+            return dict()
+
+        with open(state_path, 'r') as f:
+            try:
+                state = json.loads(f.read())
+            except ValueError:
+                return dict()
+
+        if state.get('size') != os.path.getsize(file_path):
+            return dict()
+
+        return state
+
+    def save_download_state(self, file_path, state):
+        with open('{}.state'.format(file_path), 'w') as f:
+            f.write(json.dumps(state))
+
+    def fetch_registry(self, file_path):
+        request = self.registry_request()
+        state = self.read_download_state(file_path)
+
+        if state:
+            request.add_header('Range', 'bytes={}-'.format(state['offset']))
+
+            if state.get('validator'):
+                request.add_header('If-Range', state['validator'])
+
+        with gevent.Timeout(self.connect_timeout, socket.timeout('Connection to remote registry timed out')):
+            response = self.urlopen(request, timeout=self.read_timeout)
+
+        if response.code not in (200, 206):
+            return response, None
+
         logger.info(
-            'Save response to \'registry.xml\' file...',
+            'Server response status: {}'.format(response.code),
             extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
         )
 
-        with open(os.path.join(self.DATA_PATH, 'registry.xml'), 'w') as f:
-            f.write(xml)
-            logger.info(
-                'File \'registry.xml\' saved at: {}.'.format(get_now()),
-                extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
-            )
+        if response.code == 200:
+            state = dict()
+
+        state['validator'] = response.info().getheader('ETag') or response.info().getheader('Last-Modified')
+
+        return response, self.download_registry(response, file_path, state)
 
     def get_registry(self):
         logger.info('Get remote registry...', extra=journal_context({'MESSAGE_ID': BRIDGE_INFO}, {}))
+
+        registry_xml = os.path.join(self.DATA_PATH, 'registry.xml')
+        registry_tmp = '{}.tmp'.format(registry_xml)
+
         try:
-            response = self.urlopen(self.source_registry)
+            response, digest = self.retrying.call(self.fetch_registry, registry_tmp)
         except ValueError:
             logger.info(
                 'Error! Unknown url type: {}'.format(self.source_registry),
                 extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
             )
             return
+        except HTTPError as e:
+            if e.code == 304:
+                logger.info(
+                    'Remote registry not modified. Skipping update local registry file.',
+                    extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+                )
+                self.save_registry_meta(self.read_registry_meta())
+            else:
+                if e.code == 416:
+                    self._remove_tmp(registry_tmp)
+                logger.info(
+                    'Error! Server response status: {}.'.format(e.code),
+                    extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+                )
+            return
+        except UnicodeDecodeError as e:
+            logger.info(e)
+            self._remove_tmp(registry_tmp)
+            return
+        except (URLError, HTTPException, socket.error) as e:
+            logger.info(
+                'Error! Remote registry download failed: {}. Partial file kept for resume.'.format(e),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+            )
+            return
 
-        if response and response.code != 200:
+        if digest is None:
             logger.info(
                 'Error! Server response status: {}. Sending a second request...'.format(response.code),
                 extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
             )
             return
-        else:
+
+        meta = {
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+            'sha256': digest
+        }
+
+        if not file_is_empty(registry_xml) and self.read_registry_meta().get('sha256') == digest:
             logger.info(
-                'Server response status: {}'.format(response.code),
+                'Remote registry content not changed. Skipping update local registry file.',
                 extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
             )
+            self._remove_tmp(registry_tmp)
+            self.save_registry_meta(meta)
+            return
+
+        if not self.registry_valid(registry_tmp):
+            logger.warn(
+                'Error! Remote registry is not a valid xml document.',
+                extra=journal_context({'MESSAGE_ID': BRIDGE_PARSER_ERROR}, {})
+            )
+            self._remove_tmp(registry_tmp)
+            return
+
+        os.rename(registry_tmp, registry_xml)
+        self.save_registry_meta(meta)
+        logger.info(
+            'File \'registry.xml\' saved at: {}.'.format(get_now()),
+            extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+        )
+        return registry_xml
 
-        content = response.readlines()
+    def registry_valid(self, file_path):
+        if not self.extract_in_subprocess:
+            return xml_file_valid(file_path)
 
         try:
-            content = ''.join(map(decode_cp1251, content)).encode('utf-8').strip()
-        except UnicodeDecodeError as e:
-            logger.info(e)
-            return
+            return run_in_subprocess('validate', file_path)
+        except RuntimeError as e:
+            logger.warn(e, extra=journal_context({'MESSAGE_ID': BRIDGE_PARSER_ERROR}, {}))
+            return False
+
+    def download_registry(self, response, file_path, state=None):
+        state = state or dict()
+        offset = state.get('offset', 0)
+        decoder = codecs.getincrementaldecoder('cp1251')()
+        digest = hashlib.sha256()
+        head = not offset
 
-        if XMLParser(content).document_valid:
-            self.save_registry(content)
-            return content
+        if offset:
+            logger.info(
+                'Resume download to \'{}\' file from byte {}...'.format(os.path.basename(file_path), offset),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+            )
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+        else:
+            logger.info(
+                'Save response to \'{}\' file...'.format(os.path.basename(file_path)),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_REGISTER}, {})
+            )
+
+        with open(file_path, 'ab' if offset else 'wb') as f:
+            try:
+                while True:
+                    chunk = response.read(self.chunk_size)
+
+                    if not chunk:
+                        break
+
+                    offset += len(chunk)
+                    text = decoder.decode(chunk)
+
+                    if head:
+                        text = text.lstrip()
+                        head = not text
+
+                    chunk = text.encode('utf-8')
+                    digest.update(chunk)
+                    f.write(chunk)
+            except (HTTPException, socket.error):
+                f.flush()
+                state.update(offset=offset, size=os.path.getsize(file_path))
+                self.save_download_state(file_path, state)
+                raise
+
+            chunk = decoder.decode('', final=True).encode('utf-8')
+            digest.update(chunk)
+            f.write(chunk)
+
+        if file_exists('{}.state'.format(file_path)):
+            os.remove('{}.state'.format(file_path))
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _remove_tmp(file_path):
+        for path in (file_path, '{}.state'.format(file_path)):
+            if file_exists(path):
+                os.remove(path)
 
     @property
     def registry_update_time(self):
@@ -112,10 +327,19 @@ class Registry(BaseWorker):
         else:
             return False
 
+    @property
+    def registry_last_check(self):
+        last_modified = get_file_last_modified(self.registry_xml)
+        last_check = get_file_last_modified(os.path.join(self.DATA_PATH, 'registry.meta'))
+
+        if last_check and last_check > last_modified:
+            return last_check
+        return last_modified
+
     def update_local_registry(self):
         while self.INFINITY_LOOP:
             now = get_now()
-            last_modified = get_file_last_modified(self.registry_xml)
+            last_modified = self.registry_last_check
 
             conditions = (
                 now.date() > last_modified.date() and self.registry_update_time, file_is_empty(self.registry_xml)
@@ -149,7 +373,8 @@ class Registry(BaseWorker):
 
 
 class JsonFormer(BaseWorker):
-    def __init__(self, db, delay, json_files_delay, cache_monitoring_delay, services_not_available):
+    def __init__(self, db, delay, json_files_delay, cache_monitoring_delay, services_not_available,
+                 extract_in_subprocess=False, snapshot_path=None):
         super(JsonFormer, self).__init__(services_not_available)
         self.start_time = get_now()
 
@@ -161,6 +386,8 @@ class JsonFormer(BaseWorker):
         self.delay = delay
         self.json_files_delay = json_files_delay
         self.cache_monitoring_delay = cache_monitoring_delay
+        self.extract_in_subprocess = extract_in_subprocess
+        self.snapshot_path = snapshot_path or os.path.join(self.DATA_PATH, SNAPSHOT_FILE)
 
         self.inn_json_last_check = None
         self.atc_json_last_check = None
@@ -179,7 +406,27 @@ class JsonFormer(BaseWorker):
         self.inn2atc_json = os.path.join(self.DATA_PATH, 'inn2atc.json')
         self.atc2inn_json = os.path.join(self.DATA_PATH, 'atc2inn.json')
 
-    def update_json(self, name):
+    def extract_values(self):
+        logger.info('Extract values from registry...', extra=journal_context({'MESSAGE_ID': BRIDGE_INFO}, {}))
+
+        if self.extract_in_subprocess:
+            try:
+                values = run_in_subprocess('extract', self.registry_xml)
+            except RuntimeError as e:
+                logger.warn(e, extra=journal_context({'MESSAGE_ID': BRIDGE_PARSER_ERROR}, {}))
+                return
+        else:
+            values = extract_values(self.registry_xml)
+
+        if values is None:
+            logger.warn(
+                'Error! Registry file is not a valid xml document.',
+                extra=journal_context({'MESSAGE_ID': BRIDGE_PARSER_ERROR}, {})
+            )
+
+        return values
+
+    def update_json(self, name, values=None, publish=True):
         logger.info(
             'Update local {}.json file...'.format(self.eq_valid_names.get(name)),
             extra=journal_context({'MESSAGE_ID': BRIDGE_INFO}, {})
@@ -194,30 +441,23 @@ class JsonFormer(BaseWorker):
             )
             return
 
-        with open(self.registry_xml) as registry:
-            xml_parser = XMLParser(registry.read())
-
-        if name == 'mnn':
-            values = {v.decode('utf-8').lower(): v.decode('utf-8') for v in xml_parser.get_values(name) if v}
-            self.inn_json_last_check = get_now()
-        elif name == 'atc1':
-            values = {v.decode('utf-8'): v.decode('utf-8') for v in xml_parser.get_values(name) if v}
-            self.atc_json_last_check = get_now()
-        elif name == 'inn2atc':
-            values = xml_parser.inn2atc_atc2inn(root='inn')
-            values = {k.lower(): v for k, v in values.items()}
-            self.inn2atc_json_last_check = get_now()
-        elif name == 'atc2inn':
-            values = xml_parser.inn2atc_atc2inn(root='atc')
-            values = {k: [i.lower() for i in v] for k, v in values.items()}
-            self.atc2inn_json_last_check = get_now()
-        else:
+        if name not in self.eq_valid_names:
             logger.warn(
                 'Error! Incorrect xml tag.',
                 extra=journal_context({'MESSAGE_ID': BRIDGE_PARSER_ERROR}, {})
             )
             return
 
+        if values is None:
+            values = self.extract_values()
+
+            if values is None:
+                return
+
+            values = values.get(name)
+
+        setattr(self, '{}_json_last_check'.format(self.eq_valid_names.get(name)), get_now())
+
         name = self.eq_valid_names.get(name)
 
         with open(file_path, 'r') as f:
@@ -244,7 +484,11 @@ class JsonFormer(BaseWorker):
                     'DONE. Local {}.json file updated.'.format(name),
                     extra=journal_context({'MESSAGE_ID': BRIDGE_FILE}, {})
                 )
-                self._update_cache(name)
+
+                if publish:
+                    self._update_cache()
+
+                return True
             else:
                 logger.info(
                     '{} values in remote registry not changed. Skipping update local {}.json file'.format(
@@ -264,7 +508,11 @@ class JsonFormer(BaseWorker):
                 'DONE. Local {}.json file updated.'.format(name),
                 extra=journal_context({'MESSAGE_ID': BRIDGE_FILE}, {})
             )
-            self._update_cache(name)
+
+            if publish:
+                self._update_cache()
+
+            return True
 
     def update_json_files(self):
         while True:
@@ -282,46 +530,96 @@ class JsonFormer(BaseWorker):
 
             eq_valid_names = (('mnn', 'inn'), ('atc1', 'atc'), ('inn2atc', 'inn2atc'), ('atc2inn', 'atc2inn'))
 
+            names = list()
+
             for name, eq_name in eq_valid_names:
                 if file_is_empty(files_dict.get(eq_name)):
-                    self.update_json(name)
+                    names.append(name)
                 else:
                     if now.date() >= registry_last_modified.date():
                         last_check = last_check_dict.get(eq_name)
 
                         if not last_check or registry_last_modified.date() > last_check.date():
-                            self.update_json(name)
+                            names.append(name)
 
-            gevent.sleep(self.json_files_delay)
+            if names and not file_is_empty(self.registry_xml):
+                values = self.extract_values()
 
-    def _update_cache(self, name):
-        logger.info('Update cache for {}...'.format(name), extra=journal_context({'MESSAGE_ID': BRIDGE_INFO}, {}))
-        file_path = os.path.join(self.DATA_PATH, '{}.json'.format(name))
+                if values is not None:
+                    updated = [self.update_json(name, values.get(name), publish=False) for name in names]
 
-        with open(file_path, 'r') as f:
-            if not file_is_empty(file_path):
-                data = json.loads(f.read())
+                    # all dictionaries are published together as one cache generation
+                    if any(updated):
+                        self._update_cache()
 
-                self.db.remove(name)
-                self.db.put(name, data)
+            gevent.sleep(self.json_files_delay)
 
-                logger.info(
-                    'Cache updated for {}.'.format(name),
-                    extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
-                )
+    def _update_cache(self):
+        logger.info('Update cache...', extra=journal_context({'MESSAGE_ID': BRIDGE_INFO}, {}))
+        values = dict()
+
+        for name in self.eq_valid_names.values():
+            file_path = os.path.join(self.DATA_PATH, '{}.json'.format(name))
+
+            if file_exists(file_path) and not file_is_empty(file_path):
+                with open(file_path, 'r') as f:
+                    values[name] = json.loads(f.read())
             else:
                 logger.warn(
                     'Cache not updated for {}. Registry file is empty.'.format(name),
                     extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
                 )
 
+        if values:
+            generation = self.db.publish(values)
+
+            logger.info(
+                'Cache updated for {}. Generation {}.'.format(', '.join(sorted(values)), generation),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
+            )
+            self._update_snapshot(generation, values)
+
+    def _update_snapshot(self, generation, values):
+        try:
+            if self.extract_in_subprocess:
+                # indexes are built and serialized by the worker process as well, off the bridge's gevent hub
+                run_in_subprocess(
+                    'snapshot', self.snapshot_path, str(generation), str(self.db.compression_level),
+                    *[os.path.join(self.DATA_PATH, '{}.json'.format(name)) for name in sorted(values)]
+                )
+            else:
+                write_snapshot(
+                    self.snapshot_path, generation, values, self.db.compression_level, indexes=search_indexes(values)
+                )
+        except (EnvironmentError, RuntimeError) as e:
+            logger.warn(
+                'Snapshot not updated. {}'.format(e),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
+            )
+
+            # API workers fall back to the cache instead of serving the previous generation
+            if file_exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
+        else:
+            logger.info(
+                'Snapshot updated. Generation {}.'.format(generation),
+                extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
+            )
+
     def cache_monitoring(self):
         while True:
             gevent.sleep(self.cache_monitoring_delay)
 
-            for _, name in self.eq_valid_names.items():
-                if not len(self.db.keys(name)) > 0:
-                    self._update_cache(name)
+            generation = self.db.generation()
+
+            if not all(self.db.published(name, generation) for name in self.eq_valid_names.values()):
+                self._update_cache()
+            elif 0 <= self.db.generation_ttl() < CACHE_REFRESH_AHEAD:
+                self.db.touch(self.eq_valid_names.values())
+                logger.info(
+                    'Cache generation {} expires soon. TTL extended.'.format(generation),
+                    extra=journal_context({'MESSAGE_ID': BRIDGE_CACHE}, {})
+                )
 
     def _start_jobs(self):
         logger.info('Starting jobs...')
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Registry values extraction and snapshot building, run in the bridge process or in a worker process
+
+
+import os
+import sys
+import json
+import marshal
+import logging
+
+from gevent import subprocess
+
+from openprocurement.medicines.registry.utils import XMLParser, xml_file_valid
+from openprocurement.medicines.registry.databridge.indexes import search_indexes
+from openprocurement.medicines.registry.databridge.mapped_snapshot import write_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+MODULE = 'openprocurement.medicines.registry.databridge.extractor'
+
+
+def extract_values(registry_xml):
+    xml_parser = XMLParser(registry_xml, stream=True)
+    values = xml_parser.extract()
+
+    if not xml_parser.document_valid:
+        return
+
+    inn2atc = dict()
+
+    for inn, atc in values['inn2atc'].items():
+        inn2atc.setdefault(inn.lower(), set()).update(atc)
+
+    return {
+        'mnn': {v.lower(): v for v in values['mnn']},
+        'atc1': {v: v for v in values['atc1']},
+        'inn2atc': {k: list(v) for k, v in inn2atc.items()},
+        'atc2inn': {k: list({i.lower() for i in v}) for k, v in values['atc2inn'].items()}
+    }
+
+
+def build_snapshot(snapshot_path, generation, compression_level, *json_files):
+    # dictionaries are read back from the published json files, named after them
+    values = dict()
+
+    for file_path in json_files:
+        with open(file_path, 'r') as f:
+            values[os.path.splitext(os.path.basename(file_path))[0]] = json.loads(f.read())
+
+    write_snapshot(snapshot_path, int(generation), values, int(compression_level), indexes=search_indexes(values))
+
+
+COMMANDS = {
+    'validate': xml_file_valid,
+    'extract': extract_values,
+    'snapshot': build_snapshot
+}
+
+
+def run_in_subprocess(command, *args):
+    # buildout scripts set sys.path up in-process, so the bare interpreter needs it passed on explicitly
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen(
+        [sys.executable, '-m', MODULE, command] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=env
+    )
+    out, err = process.communicate()
+
+    if process.returncode != 0:
+        raise RuntimeError('Worker process exited with code {}: {}'.format(process.returncode, err.strip()))
+
+    return marshal.loads(out)
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    command, args = sys.argv[1], sys.argv[2:]
+    sys.stdout.write(marshal.dumps(COMMANDS[command](*args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Search indexes over the registry dictionaries
+
+
+import re
+import json
+
+from bisect import bisect_left
+from collections import Counter
+
+from openprocurement.medicines.registry.utils import to_unicode
+
+
+TRIGRAMS_SECTION = 'inn_trigrams'
+ATC_TREE_SECTION = 'atc_tree'
+ATC_LEVELS = (1, 3, 4, 5, 7)
+SEARCH_CANDIDATES = 200
+SEARCH_THRESHOLD = 0.3
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def trigrams(value):
+    # words are padded like in pg_trgm, so the beginning of a word weighs more than its end
+    result = set()
+
+    for word in WORD.findall(to_unicode(value).lower()):
+        word = u'  {} '.format(word)
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+
+    return result
+
+
+def build_trigrams(entries):
+    index = dict()
+
+    for key in entries:
+        for trigram in trigrams(key):
+            index.setdefault(trigram, list()).append(key)
+
+    return {trigram: sorted(keys) for trigram, keys in index.items()}
+
+
+def atc_path(code):
+    # root, ancestors on the ATC levels and the code itself: '', A, A01, A01A, A01AA, A01AA01
+    return [u''] + [code[:length] for length in ATC_LEVELS if length < len(code)] + [code]
+
+
+def build_atc_tree(atc2inn, codes=()):
+    nodes = dict()
+
+    def node(code):
+        return nodes.setdefault(code, {'children': set(), 'descendants': set(), 'inns': set()})
+
+    for code in set(atc2inn) | set(codes):
+        inns = atc2inn.get(code) or []
+        path = atc_path(code)
+        node(code)['inns'].update(inns)
+
+        for i, parent in enumerate(path[:-1]):
+            node(parent)['children'].add(path[i + 1])
+            node(parent)['descendants'].update(path[i + 1:])
+            node(parent)['inns'].update(inns)
+
+    return {code: {k: sorted(v) for k, v in value.items()} for code, value in nodes.items()}
+
+
+def search_indexes(values):
+    # extra sections of the mapped snapshot, built by the bridge on every publish
+    indexes = dict()
+
+    if 'inn' in values:
+        indexes[TRIGRAMS_SECTION] = {'data': build_trigrams(values['inn'].get('data') or {})}
+
+    if 'atc2inn' in values or 'atc' in values:
+        indexes[ATC_TREE_SECTION] = {'data': build_atc_tree(
+            values.get('atc2inn', {}).get('data') or {}, values.get('atc', {}).get('data') or {}
+        )}
+
+    return indexes
+
+
+def rank(query, postings, limit, candidates=SEARCH_CANDIDATES, threshold=SEARCH_THRESHOLD):
+    # keys sharing most trigrams with the query are scored by trigram similarity (Jaccard)
+    query = trigrams(query)
+    counts = Counter()
+
+    for keys in postings.values():
+        counts.update(keys)
+
+    results = list()
+
+    for key, shared in counts.most_common(candidates):
+        score = shared / float(len(query | trigrams(key)))
+
+        if score >= threshold:
+            results.append((score, key))
+
+    results.sort(key=lambda result: (-result[0], result[1]))
+    return results[:limit]
+
+
+class PrefixIndex(object):
+    # same ordering as the mapped snapshot: utf-8 bytes of the keys
+    def __init__(self, entries):
+        items = sorted((to_unicode(k).encode('utf-8'), v) for k, v in entries.items())
+        self.keys = [k for k, _ in items]
+        self.values = [v for _, v in items]
+
+    def prefix(self, prefix, limit):
+        prefix = to_unicode(prefix).encode('utf-8')
+        entries = list()
+
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix) or len(entries) >= limit:
+                break
+
+            entries.append((self.keys[i].decode('utf-8'), self.values[i]))
+
+        return entries
+
+
+class TrigramIndex(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.index = build_trigrams(entries)
+
+    def lookup_many(self, keys):
+        return {key: self.index[key] for key in keys if key in self.index}
+
+
+class AtcTree(object):
+    # atc2inn and atc dictionaries, as search_indexes builds it for the mapped snapshot
+    def __init__(self, atc2inn, codes=()):
+        self.nodes = build_atc_tree(atc2inn, codes)
+
+    def lookup_many(self, keys):
+        return {key: self.nodes[key] for key in keys if key in self.nodes}
+
+
+class IndexCache(object):
+    # per process indexes over the cache snapshot, used when the mapped snapshot is not available
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.indexes = dict()
+
+    def get(self, names, factory):
+        # factory gets the data of every dictionary in names, an index over several dictionaries takes a tuple
+        names = names if isinstance(names, tuple) else (names,)
+        snapshots = [self.snapshots.get(name) for name in names]
+        generation = snapshots[0][0]
+
+        if not any(snapshot and snapshot.body for _, snapshot in snapshots):
+            return generation, None
+
+        cached = self.indexes.get((names, factory))
+
+        if cached is None or cached[0] != generation:
+            data = [json.loads(snapshot.body).get('data') or {} if snapshot and snapshot.body else {}
+                    for _, snapshot in snapshots]
+            cached = generation, factory(*data)
+            self.indexes[(names, factory)] = cached
+
+        return cached
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# File backed store with the subset of the redis client interface used by caching.DB. Every key is a file written
+# atomically (temp file + rename), so the bridge process writes and any number of API worker processes read it.
+# Point cache_path at tmpfs (e.g. /dev/shm) to keep the store in shared memory.
+#
+# A key file starts with a fixed-size header (format marker, expire_at or 0 when the key never expires) followed
+# by the marshalled value, so exists, ttl and expire never load the (multi-megabyte) value.
+
+
+import os
+import time
+import errno
+import struct
+import fcntl
+import marshal
+import fnmatch
+import tempfile
+import gevent
+
+from math import ceil
+from urllib import quote, unquote
+from contextlib import contextmanager
+
+
+LOCAL_POLL_INTERVAL = 1.0
+LOCK_FILE = '.lock'
+TMP_PREFIX = '.tmp'
+CHANNEL_PREFIX = '.channel-'
+KEY_HEADER = struct.Struct('<4sd')
+KEY_FORMAT = 'ls1:'
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+    return value
+
+
+class LocalStore(object):
+    def __init__(self, path, poll_interval=LOCAL_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.locked = False
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _file(self, key):
+        return os.path.join(self.path, quote(encode(key), safe=''))
+
+    def _load(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                return marshal.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _dump(self, file_path, record, header=''):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=TMP_PREFIX)
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            marshal.dump(record, f)
+
+        os.rename(tmp, file_path)
+
+    def _load_key(self, file_path, value=True):
+        # (expire_at, value), the value is None unless asked for
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(KEY_HEADER.size)
+
+                if len(header) != KEY_HEADER.size:
+                    return None
+
+                key_format, expire_at = KEY_HEADER.unpack(header)
+
+                if key_format != KEY_FORMAT:
+                    return None
+
+                return expire_at or None, marshal.load(f) if value else None
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _read(self, key, value=True):
+        file_path = self._file(key)
+        record = self._load_key(file_path, value)
+
+        if record is None or record[0] is None or record[0] > time.time():
+            return record
+
+        self._remove_expired(file_path)
+
+    def _remove_expired(self, file_path):
+        # expired keys are removed on access, the file may have been rewritten since it was read
+        with self._lock():
+            record = self._load_key(file_path, value=False)
+
+            if record is not None and record[0] is not None and record[0] <= time.time():
+                try:
+                    os.remove(file_path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _write(self, key, value, expire_at=None):
+        self._dump(self._file(key), value, KEY_HEADER.pack(KEY_FORMAT, expire_at or 0))
+
+    @contextmanager
+    def _lock(self):
+        # reentrant, flock on a second descriptor of the lock file would block the holder itself
+        if self.locked:
+            yield
+            return
+
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.locked = True
+
+            try:
+                yield
+            finally:
+                self.locked = False
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key):
+        record = self._read(key)
+
+        if record is not None and isinstance(record[1], str):
+            return record[1]
+
+    def set(self, key, value, ex=None):
+        self._write(key, encode(value), time.time() + ex if ex else None)
+        return True
+
+    def exists(self, key):
+        return self._read(key, value=False) is not None
+
+    def delete(self, *keys):
+        removed = 0
+
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+                removed += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return removed
+
+    def incr(self, key, amount=1):
+        with self._lock():
+            record = self._read(key) or (None, '0')
+            value = int(record[1]) + amount
+            self._write(key, str(value), record[0])
+
+        return value
+
+    def ttl(self, key):
+        record = self._read(key, value=False)
+
+        if record is None:
+            return -2
+        elif record[0] is None:
+            return -1
+
+        return int(ceil(record[0] - time.time()))
+
+    def expire(self, key, seconds):
+        with self._lock():
+            if self._read(key, value=False) is None:
+                return False
+
+            # only the header is rewritten, in place
+            fd = os.open(self._file(key), os.O_WRONLY)
+
+            try:
+                os.write(fd, KEY_HEADER.pack(KEY_FORMAT, time.time() + seconds))
+            finally:
+                os.close(fd)
+
+        return True
+
+    def hget(self, key, field):
+        record = self._read(key)
+
+        if record is not None and isinstance(record[1], dict):
+            return record[1].get(encode(field))
+
+    def hmget(self, key, fields):
+        record = self._read(key)
+        values = record[1] if record is not None and isinstance(record[1], dict) else dict()
+        return [values.get(encode(field)) for field in fields]
+
+    def hgetall(self, key):
+        record = self._read(key)
+        return dict(record[1]) if record is not None and isinstance(record[1], dict) else dict()
+
+    def hmset(self, key, mapping):
+        with self._lock():
+            record = self._read(key) or (None, dict())
+            record[1].update({encode(k): encode(v) for k, v in mapping.items()})
+            self._write(key, record[1], record[0])
+
+        return True
+
+    def hlen(self, key):
+        record = self._read(key)
+        return len(record[1]) if record is not None and isinstance(record[1], dict) else 0
+
+    def scan_iter(self, match=None, count=None):
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+
+            key = unquote(name)
+
+            if (match is None or fnmatch.fnmatchcase(key, match)) and self._read(key, value=False) is not None:
+                yield key
+
+    def keys(self, pattern='*'):
+        return list(self.scan_iter(pattern))
+
+    def purge(self):
+        # nothing expires on its own, files of keys nobody reads again (superseded generations) are removed here
+        for name in os.listdir(self.path):
+            if not name.startswith('.'):
+                self._read(unquote(name), value=False)
+
+    def flushall(self):
+        for name in os.listdir(self.path):
+            if name != LOCK_FILE:
+                os.remove(os.path.join(self.path, name))
+
+        return True
+
+    def pipeline(self, transaction=False):
+        return LocalPipeline(self)
+
+    def publish(self, channel, message):
+        file_path = os.path.join(self.path, CHANNEL_PREFIX + quote(encode(channel), safe=''))
+
+        with self._lock():
+            sequence = (self._load(file_path) or (0, None))[0] + 1
+            self._dump(file_path, (sequence, encode(message)))
+
+        return 1
+
+    def channel_message(self, channel):
+        return self._load(os.path.join(self.path, CHANNEL_PREFIX + quote(encode(channel), safe=''))) or (0, None)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self)
+
+
+class LocalPipeline(object):
+    def __init__(self, store):
+        self.store = store
+        self.commands = list()
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, list()
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class LocalPubSub(object):
+    def __init__(self, store):
+        self.store = store
+        self.channels = dict()
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            self.channels[channel] = self.store.channel_message(channel)[0]
+
+    def listen(self):
+        while True:
+            gevent.sleep(self.store.poll_interval)
+
+            for channel, sequence in self.channels.items():
+                current, message = self.store.channel_message(channel)
+
+                if current != sequence:
+                    self.channels[channel] = current
+                    yield {'type': 'message', 'pattern': None, 'channel': channel, 'data': message}
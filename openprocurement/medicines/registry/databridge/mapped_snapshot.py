@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# Read-only binary snapshot of a published cache generation. The bridge writes it next to the registry files and
+# every API worker process mmaps it, so the dictionaries are shared between processes through the page cache.
+#
+# Layout (little-endian):
+#   header     magic, generation, number of sections
+#   sections   name, number of entries, offsets and lengths of the entries index, body and gzip body
+#   per section
+#     index    (key offset, key length, value offset, value length) records sorted by utf-8 key
+#     keys     utf-8 keys
+#     values   json encoded values
+#     body     json encoded dictionary as served by the registry endpoint, empty for index sections
+#     gzip     gzip compressed body, empty when compression is disabled and for index sections
+
+
+import os
+import mmap
+import json
+import struct
+import tempfile
+
+from time import time
+
+from openprocurement.medicines.registry.utils import to_unicode
+from openprocurement.medicines.registry.databridge.caching import (
+    Snapshot, encode_payload, payload_body, payload_gzip
+)
+
+
+MAGIC = 'MRS1'
+HEADER = struct.Struct('<4sQI')
+SECTION = struct.Struct('<16sIQQQQQ')
+SECTION_NAME_LENGTH = 16
+INDEX = struct.Struct('<QIQI')
+
+SNAPSHOT_FILE = 'registry.snapshot'
+MAPPED_CHECK_INTERVAL = 1
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def write_snapshot(path, generation, values, compression_level=0, indexes=None):
+    # values are the dictionaries served by the registry endpoint, indexes are only looked up by key, so their
+    # sections are written without a body
+    sections = dict((name, (value, True)) for name, value in values.items())
+    sections.update((name, (value, False)) for name, value in (indexes or {}).items())
+
+    for name in sections:
+        # struct would silently truncate the name, and readers would then miss the section
+        if len(name) > SECTION_NAME_LENGTH:
+            raise ValueError('Snapshot section name {!r} is longer than {} bytes'.format(name, SECTION_NAME_LENGTH))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    headers = list()
+    blobs = list()
+
+    for name in sorted(sections):
+        value, with_body = sections[name]
+        entries = sorted(
+            (to_unicode(key).encode('utf-8'), dumps(entry)) for key, entry in (value.get('data') or {}).items()
+        )
+
+        if with_body:
+            payload = encode_payload(value, compression_level)
+            body, gzip = payload_body(payload), payload_gzip(payload) or ''
+        else:
+            body, gzip = '', ''
+
+        index_offset = offset
+        keys_offset = index_offset + INDEX.size * len(entries)
+        values_offset = keys_offset + sum(len(key) for key, _ in entries)
+        body_offset = values_offset + sum(len(value) for _, value in entries)
+        gzip_offset = body_offset + len(body)
+        offset = gzip_offset + len(gzip)
+
+        index = list()
+        key_offset, value_offset = keys_offset, values_offset
+
+        for key, value in entries:
+            index.append(INDEX.pack(key_offset, len(key), value_offset, len(value)))
+            key_offset += len(key)
+            value_offset += len(value)
+
+        headers.append(SECTION.pack(name, len(entries), index_offset, body_offset, len(body), gzip_offset, len(gzip)))
+        blobs.extend(index)
+        blobs.extend(key for key, _ in entries)
+        blobs.extend(value for _, value in entries)
+        blobs.extend((body, gzip))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}'.format(os.path.basename(path)))
+
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, generation, len(sections)))
+
+        for data in headers + blobs:
+            f.write(data)
+
+    # readers keep the old mapping until they notice the new file
+    os.rename(tmp, path)
+
+
+class MappedBody(object):
+    # body served as a response app_iter straight from the mapping, in chunks, so the whole dictionary is never
+    # copied to the worker's heap. It keeps the mapping alive, a re-mapped snapshot does not affect it.
+    def __init__(self, mapped, offset, length):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        end = self.offset + self.length
+
+        for start in range(self.offset, end, BODY_CHUNK_SIZE):
+            yield self.mapped[start:min(start + BODY_CHUNK_SIZE, end)]
+
+    def __str__(self):
+        return self.mapped[self.offset:self.offset + self.length]
+
+
+class MappedView(object):
+    # one mapping with its generation, so every read of a request comes from the same snapshot
+    def __init__(self, mapped, generation, sections):
+        self.mapped = mapped
+        self.generation = generation
+        self.sections = sections
+
+    def get(self, name):
+        section = self.sections.get(name)
+
+        # index sections have no body to serve
+        if section is None or not section[3]:
+            return None, None
+
+        _, _, body_offset, body_length, gzip_offset, gzip_length = section
+        body = MappedBody(self.mapped, body_offset, body_length)
+        gzip = MappedBody(self.mapped, gzip_offset, gzip_length) if gzip_length else None
+
+        return self.generation, Snapshot(body, gzip)
+
+    def lookup(self, name, key):
+        section = self.sections.get(name)
+
+        if section is not None:
+            return self.find(section, key)
+
+    def lookup_many(self, name, keys):
+        section = self.sections.get(name)
+
+        if section is None:
+            return None
+
+        entries = dict()
+
+        for key in keys:
+            value = self.find(section, key)
+
+            if value is not None:
+                entries[key] = value
+
+        return entries
+
+    def prefix(self, name, prefix, limit):
+        # keys are sorted, so matches are the contiguous run starting at the lower bound of the prefix
+        section = self.sections.get(name)
+
+        if section is None:
+            return None
+
+        prefix = to_unicode(prefix).encode('utf-8')
+        entries = list()
+
+        for i in range(self.bisect(section, prefix), section[0]):
+            key_offset, key_length, value_offset, value_length = self.record(section, i)
+            key = self.mapped[key_offset:key_offset + key_length]
+
+            if not key.startswith(prefix) or len(entries) >= limit:
+                break
+
+            entries.append((key.decode('utf-8'), json.loads(self.mapped[value_offset:value_offset + value_length])))
+
+        return entries
+
+    def find(self, section, key):
+        key = to_unicode(key).encode('utf-8')
+        i = self.bisect(section, key)
+
+        if i < section[0]:
+            key_offset, key_length, value_offset, value_length = self.record(section, i)
+
+            if self.mapped[key_offset:key_offset + key_length] == key:
+                return json.loads(self.mapped[value_offset:value_offset + value_length])
+
+    def bisect(self, section, key):
+        low, high = 0, section[0]
+
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length = self.record(section, middle)[:2]
+
+            if self.mapped[key_offset:key_offset + key_length] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def record(self, section, i):
+        return INDEX.unpack_from(self.mapped, section[1] + INDEX.size * i)
+
+
+class MappedSnapshot(object):
+    def __init__(self, path, check_interval=MAPPED_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.mapped = None
+        self.stat = None
+        self.generation = None
+        self.sections = dict()
+        self.checked_at = None
+
+    def refresh(self):
+        if self.checked_at is not None and time() - self.checked_at < self.check_interval:
+            return
+
+        self.checked_at = time()
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.close()
+            return
+
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+        if stat != self.stat:
+            try:
+                self.open()
+            except (EnvironmentError, ValueError, struct.error):
+                self.close()
+                return
+
+            self.stat = stat
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, generation, count = HEADER.unpack_from(mapped, 0)
+
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError('{} is not a registry snapshot'.format(self.path))
+
+        sections = dict()
+
+        for i in range(count):
+            section = SECTION.unpack_from(mapped, HEADER.size + SECTION.size * i)
+            sections[section[0].rstrip('\0')] = section[1:]
+
+        self.close()
+        self.mapped, self.generation, self.sections = mapped, generation, sections
+
+    def close(self):
+        # not unmapped explicitly, bodies of in-flight responses may still reference the mapping
+        self.mapped, self.stat, self.generation, self.sections = None, None, None, dict()
+
+    def pin(self):
+        self.refresh()
+        return MappedView(self.mapped, self.generation, self.sections)
+
+    def get(self, name):
+        return self.pin().get(name)
+
+    def lookup(self, name, key):
+        return self.pin().lookup(name, key)
+
+    def lookup_many(self, name, keys):
+        return self.pin().lookup_many(name, keys)
+
+    def prefix(self, name, prefix, limit):
+        return self.pin().prefix(name, prefix, limit)
@@ -10,3 +10,4 @@ BRIDGE_RESTART_CACHE_MONITORING = 'bridge_restart_cache_monitoring'
 BRIDGE_PROXY_SERVER_CONN_ERROR = 'bridge_proxy_server_conn_error'
 API_ERROR_HANDLER = 'error_handler'
 API_INFO = 'api_info'
+API_CACHE = 'api_cache'
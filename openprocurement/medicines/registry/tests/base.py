@@ -1,14 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
 import unittest
-import subprocess
 import webtest
 
-from time import sleep
 from nose import tools
 from bottle import Bottle, response, request
 from gevent.pywsgi import WSGIServer
-from redis import StrictRedis
 
 from openprocurement.medicines.registry import VERSION
 from openprocurement.medicines.registry.databridge.caching import DB
@@ -19,9 +16,9 @@ config = {
     'proxy_host': '127.0.0.1',
     'proxy_port': 8008,
     'proxy_version': 1.0,
-    'cache_db_name': 0,
-    'cache_host': '127.0.0.1',
-    'cache_port': '6379',
+    'cache_backend': 'local',
+    'cache_path': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'),
+    'snapshot_path': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registry.snapshot'),
     'delay': 1,
     'time_update_at': '5:30:00',
     'registry_delay': 1,
@@ -76,6 +73,10 @@ class BaseWebTest(unittest.TestCase):
 
     def tearDown(self):
         self.db.flushall()
+        rm_dir(config.get('cache_path'))
+
+        if os.path.exists(config.get('snapshot_path')):
+            os.remove(config.get('snapshot_path'))
 
 
 @tools.nottest
@@ -88,11 +89,6 @@ class BaseServersTest(unittest.TestCase):
         cls.proxy_server_bottle = Bottle()
         cls.proxy_server = WSGIServer(('127.0.0.1', 8008), cls.proxy_server_bottle, log=None)
         setup_routing(cls.proxy_server_bottle, proxy_response, path='/api/{}/health'.format(VERSION))
-        cls.redis_process = subprocess.Popen(
-            ['redis-server', '--port', str(config.get('cache_port')), '--logfile /dev/null']
-        )
-        sleep(0.1)
-        cls.redis = StrictRedis(port=str(config.get('cache_port')))
         cls.proxy_server.start()
 
     def setUp(self):
@@ -107,13 +103,12 @@ class BaseServersTest(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.proxy_server.close()
-        cls.redis_process.terminate()
-        cls.redis_process.wait()
         del cls.proxy_server_bottle
 
     def tearDown(self):
         del self.worker
-        self.redis.flushall()
+        self.db.flushall()
+        rm_dir(config.get('cache_path'))
         self.DATA_PATH = os.path.join(self.BASE_DIR, 'temp')
         rm_dir(self.DATA_PATH)
 
@@ -1,12 +1,22 @@
+# -*- coding: utf-8 -*-
+import os
 import json
+import zlib
+import gevent
 
+from base64 import b64encode
 from gevent import event
+from mock import patch
+from webob import Request
 
 from openprocurement.medicines.registry.tests.base import BaseWebTest
 from openprocurement.medicines.registry.api import ROUTE_PREFIX
 from openprocurement.medicines.registry.databridge.components import JsonFormer
+from openprocurement.medicines.registry.databridge.caching import DB, payload_key
+from openprocurement.medicines.registry.databridge.mapped_snapshot import write_snapshot
+from openprocurement.medicines.registry.databridge.indexes import search_indexes
 from openprocurement.medicines.registry.tests.base import config
-from openprocurement.medicines.registry.utils import str_to_obj
+from openprocurement.medicines.registry.tests.utils import rm_dir
 
 
 INITIAL_ATC_KEYS_DATA = [
@@ -68,16 +78,44 @@ class TestApi(BaseWebTest):
     def test_api_with_valid_params(self):
         self.app.authorization = ('Basic', ('brokername', 'brokername'))
         request_path = '{}/registry/'.format(ROUTE_PREFIX)
+        initial_keys = {
+            'atc': INITIAL_ATC_KEYS_DATA, 'inn': INITIAL_INN_KEYS_DATA,
+            'inn2atc': INITIAL_INN_KEYS_DATA, 'atc2inn': INITIAL_ATC_KEYS_DATA
+        }
 
-        # get ATC data without cache
-        response = self.app.get(request_path + 'atc.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(any([True for i in INITIAL_ATC_KEYS_DATA if i in data.get('data')]))
-        self.assertFalse(self.db.get('atc'))
+        # json files as written by the bridge, served while the cache is empty
+        base_dir = os.path.join(self.relative_to, 'temp')
+        data_path = os.path.join(base_dir, 'data')
+        os.makedirs(data_path)
+        self.addCleanup(rm_dir, base_dir)
+
+        pairs = zip(INITIAL_INN_KEYS_DATA, INITIAL_ATC_KEYS_DATA)
+        initial_data = {
+            'atc': {atc: atc for atc in INITIAL_ATC_KEYS_DATA},
+            'inn': {inn: inn for inn in INITIAL_INN_KEYS_DATA},
+            'inn2atc': {inn: [atc] for inn, atc in pairs},
+            'atc2inn': {atc: [inn] for inn, atc in pairs}
+        }
+
+        for param, data in initial_data.items():
+            with open(os.path.join(data_path, '{}.json'.format(param)), 'w') as f:
+                f.write(json.dumps({'data': data, 'dateModified': '2018-01-01 00:00:00+02:00'}))
+
+        patcher = patch('openprocurement.medicines.registry.api.views.registry.BASE_DIR', base_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # get data without cache
+        for param, keys in initial_keys.items():
+            response = self.app.get(request_path + '{}.json'.format(param), status=200)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content_type, 'application/json')
+            self.assertNotIn('X-Registry-Generation', response.headers)
+            data = response.json
+            self.assertTrue(any([True for i in keys if i in data.get('data')]))
+            self.assertFalse(self.db.get_payload(param))
 
-        # get ATC data with cache
+        # get data with cache, all dictionaries are published as one generation
         services_not_available = event.Event()
         services_not_available.set()
 
@@ -87,72 +125,357 @@ class TestApi(BaseWebTest):
             cache_monitoring_delay=config.get('cache_monitoring_delay'),
             services_not_available=services_not_available
         )
-        json_former._update_cache('atc')
+        json_former.DATA_PATH = data_path
+        json_former._update_cache()
 
-        response = self.app.get(request_path + 'atc.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(self.db.get('atc'))
-        self.assertTrue(any([True for i in INITIAL_ATC_KEYS_DATA if i in data.get('data')]))
-        self.assertEqual(data, str_to_obj(self.db.get('atc')))
+        for param, keys in initial_keys.items():
+            response = self.app.get(request_path + '{}.json'.format(param), status=200)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content_type, 'application/json')
+            self.assertEqual(response.headers['X-Registry-Generation'], str(self.db.generation()))
+            data = response.json
+            self.assertTrue(self.db.get_payload(param))
+            self.assertTrue(any([True for i in keys if i in data.get('data')]))
+            self.assertEqual(data, self.db.get_payload(param))
 
-        # get INN data without cache
-        response = self.app.get(request_path + 'inn.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(any([True for i in INITIAL_INN_KEYS_DATA if i in data.get('data')]))
-        self.assertFalse(self.db.get('inn'))
+    def test_registry_generation_header(self):
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        request_path = '{}/registry/'.format(ROUTE_PREFIX)
 
-        # get INN data with cache
-        json_former._update_cache('inn')
+        for data in ({u'J01': u'J01'}, {u'J01': u'J01', u'B05AA': u'B05AA'}):
+            generation = self.db.publish({
+                name: {'data': data, 'dateModified': '2018-01-01 00:00:00+02:00'} for name in self.valid_params
+            })
+            gevent.sleep(0.1)
 
-        response = self.app.get(request_path + 'inn.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(self.db.get('inn'))
-        self.assertTrue(any([True for i in INITIAL_INN_KEYS_DATA if i in data.get('data')]))
-        self.assertEqual(data, str_to_obj(self.db.get('inn')))
+            for param in self.valid_params:
+                response = self.app.get(request_path + '{}.json'.format(param), status=200)
+                self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+                self.assertEqual(response.json['data'], data)
+
+    def test_registry_gzip(self):
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        request_path = '{}/registry/inn.json'.format(ROUTE_PREFIX)
+        data = {'data': {u'methyluracil': u'Methyluracil'}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        self.db.compression_level = 6
+        self.db.publish({'inn': data})
 
-        # get INN2ATC data without cache
-        response = self.app.get(request_path + 'inn2atc.json', status=200)
+        # webtest decodes gzip responses itself, so the stored bytes are checked on the wsgi level
+        request = Request.blank(request_path, headers={'Accept-Encoding': 'gzip, deflate'})
+        request.authorization = ('Basic', b64encode('brokername:brokername'))
+        response = request.get_response(self.app.app)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(any([True for i in INITIAL_INN_KEYS_DATA if i in data.get('data')]))
-        self.assertFalse(self.db.get('inn2atc'))
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(json.loads(zlib.decompress(response.body, 16 + zlib.MAX_WBITS)), data)
 
-        # get INN2ATC data with cache
-        json_former._update_cache('inn2atc')
+        response = self.app.get(request_path, headers={'Accept-Encoding': 'identity'}, status=200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.json, data)
 
-        response = self.app.get(request_path + 'inn2atc.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(self.db.get('inn2atc'))
-        self.assertTrue(any([True for i in INITIAL_INN_KEYS_DATA if i in data.get('data')]))
-        self.assertEqual(data, str_to_obj(self.db.get('inn2atc')))
+        # clients without the header or refusing gzip get plain json
+        for headers in ({}, {'Accept-Encoding': 'gzip;q=0'}, {'Accept-Encoding': 'br'}):
+            request = Request.blank(request_path, headers=headers)
+            request.authorization = ('Basic', b64encode('brokername:brokername'))
+            response = request.get_response(self.app.app)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(json.loads(response.body), data)
 
-        # get ATC2INN data without cache
-        response = self.app.get(request_path + 'atc2inn.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(any([True for i in INITIAL_ATC_KEYS_DATA if i in data.get('data')]))
-        self.assertFalse(self.db.get('atc2inn'))
+    def test_registry_shared_db(self):
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        self.db.publish({'inn': {'data': {u'methyluracil': u'Methyluracil'}}})
+        db = self.app.app.registry.db
 
-        # get ATC2INN data with cache
-        json_former._update_cache('atc2inn')
+        with patch.object(DB, '__init__') as db_init:
+            for _ in range(3):
+                self.app.app.registry.snapshots.invalidate()
+                response = self.app.get('{}/registry/inn.json'.format(ROUTE_PREFIX), status=200)
+                self.assertEqual(response.json['data'], {u'methyluracil': u'Methyluracil'})
 
-        response = self.app.get(request_path + 'atc2inn.json', status=200)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content_type, 'application/json')
-        data = response.json
-        self.assertTrue(self.db.get('atc2inn'))
-        self.assertTrue(any([True for i in INITIAL_ATC_KEYS_DATA if i in data.get('data')]))
-        self.assertEqual(data, str_to_obj(self.db.get('atc2inn')))
+            self.assertFalse(db_init.called)
+
+        self.assertIs(self.app.app.registry.db, db)
+        self.assertIs(self.app.app.registry.snapshots.db, db)
+
+    def test_registry_snapshot(self):
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        request_path = '{}/registry/inn.json'.format(ROUTE_PREFIX)
+        db = self.app.app.registry.db
+        snapshots = self.app.app.registry.snapshots
+
+        values = {name: {'data': {}} for name in self.valid_params}
+        values['inn'] = {'data': {u'methyluracil': u'Methyluracil'}}
+        generation = self.db.publish(values)
+
+        # payload of the generation not replicated yet is picked up without waiting for the next publish
+        payload = self.db.get(payload_key('atc', generation))
+        self.db.remove(payload_key('atc', generation))
+        response = self.app.get(request_path, status=200)
+        self.assertEqual(response.json['data'], {u'methyluracil': u'Methyluracil'})
+        self.db.put(payload_key('atc', generation), payload)
+        response = self.app.get('{}/registry/atc.json'.format(ROUTE_PREFIX), status=200)
+        self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+        self.assertEqual(response.json['data'], {})
+        gevent.sleep(0.1)
+
+        # steady state requests are served from the snapshot without touching the cache backend
+        with patch.object(db, 'get', wraps=db.get) as get:
+            for _ in range(3):
+                response = self.app.get(request_path, status=200)
+                self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+            self.assertFalse(get.called)
+
+            # periodic check only reads the generation pointer
+            snapshots.checked_at -= snapshots.check_interval
+            self.app.get(request_path, status=200)
+            self.assertEqual(get.call_count, 1)
+
+        # new generation is announced to the workers
+        values['inn'] = {'data': {u'paracetamol': u'Paracetamol'}}
+        generation = self.db.publish(values)
+        gevent.sleep(0.1)
+        response = self.app.get(request_path, status=200)
+        self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+        self.assertEqual(response.json['data'], {u'paracetamol': u'Paracetamol'})
+
+    def test_registry_mapped_snapshot(self):
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        request_path = '{}/registry/inn.json'.format(ROUTE_PREFIX)
+        data = {'data': {u'methyluracil': u'Methyluracil'}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        generation = self.db.publish({'inn': data})
+        write_snapshot(config.get('snapshot_path'), generation, {'inn': data}, compression_level=6)
+
+        # mapped file is served without touching the cache backend
+        with patch.object(self.app.app.registry.snapshots, 'get') as get:
+            response = self.app.get(request_path, status=200)
+            self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+            self.assertEqual(response.json, data)
+
+            request = Request.blank(request_path, headers={'Accept-Encoding': 'gzip'})
+            request.authorization = ('Basic', b64encode('brokername:brokername'))
+            response = request.get_response(self.app.app)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(zlib.decompress(response.body, 16 + zlib.MAX_WBITS)), data)
+            self.assertFalse(get.called)
+
+        # dictionaries missing from the mapped file fall back to the cache
+        self.db.publish({'inn': data, 'atc': data})
+        response = self.app.get('{}/registry/atc.json'.format(ROUTE_PREFIX), status=200)
+        self.assertEqual(response.json, data)
+
+    def test_registry_entry(self):
+        request_path = '{}/registry/'.format(ROUTE_PREFIX)
+        self.app.get(request_path + 'inn/paracetamol', status=403)
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+
+        response = self.app.get(request_path + 'inn/paracetamol', status=404)
+        self.assertEqual(response.json['errors'][0]['name'], 'name')
+
+        values = {
+            'inn2atc': {'data': {u'paracetamol': [u'N02BE01'], u'ацетилцистеїн': [u'R05CB01']}},
+            'atc2inn': {'data': {u'N02BE01': [u'paracetamol']}}
+        }
+        generation = self.db.publish(values)
+
+        def check():
+            response = self.app.get(request_path + 'inn/Paracetamol', status=200)
+            self.assertEqual(response.json, {'data': {u'paracetamol': [u'N02BE01']}})
+            self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+
+            response = self.app.get(request_path + u'inn/ацетилцистеїн'.encode('utf-8'), status=200)
+            self.assertEqual(response.json, {'data': {u'ацетилцистеїн': [u'R05CB01']}})
+
+            response = self.app.get(request_path + 'atc/n02be01', status=200)
+            self.assertEqual(response.json, {'data': {u'N02BE01': [u'paracetamol']}})
+
+            response = self.app.get(request_path + 'atc/J01', status=404)
+            self.assertEqual(response.json['errors'][0]['description'], 'ATC code not found')
+
+            response = self.app.get(request_path + 'inn/paracetamol?opt_pretty=1', status=200)
+            self.assertIn('\n', response.body)
+
+        check()
+
+        # same lookups are served from the mapped snapshot without the cache backend
+        write_snapshot(config.get('snapshot_path'), generation, values)
+
+        with patch.object(self.app.app.registry.db, 'get_entries') as get_entries:
+            check()
+            self.assertFalse(get_entries.called)
+
+    def test_registry_bulk_lookup(self):
+        request_path = '{}/registry/lookup'.format(ROUTE_PREFIX)
+        self.app.post_json(request_path, {'data': {'inn': [u'paracetamol']}}, status=403)
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+
+        generation = self.db.publish({
+            'inn2atc': {'data': {u'paracetamol': [u'N02BE01'], u'ацетилцистеїн': [u'R05CB01']}},
+            'atc2inn': {'data': {u'N02BE01': [u'paracetamol']}}
+        })
+        db = self.app.app.registry.db
+        self.app.post_json(request_path, {'data': {'inn': [u'paracetamol']}}, status=200)
+
+        # the generation pointer is not re-read per request, entries take one round-trip
+        with patch.object(db, 'generation', wraps=db.generation) as get_generation:
+            with patch.object(db.db, 'pipeline', wraps=db.db.pipeline) as pipeline:
+                response = self.app.post_json(request_path, {'data': {
+                    'inn': [u'Paracetamol', u'ацетилцистеїн', u'aspirin'], 'atc': [u'n02be01', u'J01']
+                }}, status=200)
+                self.assertEqual(pipeline.call_count, 1)
+                self.assertFalse(get_generation.called)
+
+        self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+        self.assertEqual(response.json, {
+            'data': {
+                'inn': {u'paracetamol': [u'N02BE01'], u'ацетилцистеїн': [u'R05CB01']},
+                'atc': {u'N02BE01': [u'paracetamol']}
+            },
+            'missing': {'inn': [u'aspirin'], 'atc': [u'J01']}
+        })
+
+        response = self.app.post(request_path, {'atc': [u'N02BE01', u'J01']}, status=200)
+        self.assertEqual(response.json['data'], {'inn': {}, 'atc': {u'N02BE01': [u'paracetamol']}})
+
+        for data, name in (({}, 'data'), ({'data': []}, 'data'), ({'data': {'inn': 'paracetamol'}}, 'inn'),
+                           ({'data': {'atc': [1]}}, 'atc'), ({'data': {'inn': []}}, 'data')):
+            response = self.app.post_json(request_path, data, status=422)
+            self.assertEqual(response.json['status'], 'error')
+            self.assertEqual(response.json['errors'][0]['name'], name)
+
+        with patch('openprocurement.medicines.registry.api.views.entries.BULK_LOOKUP_LIMIT', 2):
+            response = self.app.post_json(request_path, {'data': {'inn': [u'a', u'b'], 'atc': [u'C']}}, status=422)
+            self.assertEqual(response.json['errors'][0]['description'], 'At most 2 items are allowed, got 3')
+
+        self.app.get(request_path, status=404)
+
+    def test_registry_autocomplete(self):
+        request_path = '{}/registry/autocomplete'.format(ROUTE_PREFIX)
+        self.app.get(request_path, {'q': 'para'}, status=403)
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+
+        response = self.app.get(request_path, {'q': 'para'}, status=200)
+        self.assertEqual(response.json, {'data': []})
+
+        names = [u'Paracetamol', u'Paracetamol, combinations', u'Paraffin', u'Pancreatin', u'Ацетилцистеїн']
+        values = {'inn': {'data': {name.lower(): name for name in names}}}
+        generation = self.db.publish(values)
+
+        def check():
+            response = self.app.get(request_path, {'q': ' PARA'}, status=200)
+            self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+            self.assertEqual([i['name'] for i in response.json['data']], names[:3])
+            self.assertEqual(response.json['data'][0], {'inn': u'paracetamol', 'name': u'Paracetamol'})
+
+            response = self.app.get(request_path, {'q': 'paracetamol', 'limit': 1}, status=200)
+            self.assertEqual([i['name'] for i in response.json['data']], names[:1])
+
+            response = self.app.get(request_path, {'q': u'ацет'.encode('utf-8')}, status=200)
+            self.assertEqual([i['name'] for i in response.json['data']], names[4:])
+
+            response = self.app.get(request_path, {'q': 'paz'}, status=200)
+            self.assertEqual(response.json['data'], [])
+
+        check()
+
+        # same index is served from the mapped snapshot
+        write_snapshot(config.get('snapshot_path'), generation, values)
+
+        with patch.object(self.app.app.registry.indexes, 'get') as get:
+            check()
+            self.assertFalse(get.called)
+
+        for params, name in (({}, 'q'), ({'q': ' '}, 'q'), ({'q': 'a', 'limit': 'x'}, 'limit'),
+                             ({'q': 'a', 'limit': 0}, 'limit'), ({'q': 'a', 'limit': 101}, 'limit')):
+            response = self.app.get(request_path, params, status=422)
+            self.assertEqual(response.json['errors'][0]['name'], name)
+
+    def test_registry_search(self):
+        request_path = '{}/registry/search'.format(ROUTE_PREFIX)
+        self.app.get(request_path, {'q': 'paracetamol'}, status=403)
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+
+        response = self.app.get(request_path, {'q': 'paracetamol'}, status=200)
+        self.assertEqual(response.json, {'data': []})
+
+        names = [u'Paracetamol', u'Paracetamol, combinations', u'Pancreatin', u'Metamizole sodium', u'Ацетилцистеїн']
+        values = {'inn': {'data': {name.lower(): name for name in names}}}
+        generation = self.db.publish(values)
+
+        def check():
+            response = self.app.get(request_path, {'q': 'parcetamol'}, status=200)
+            self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+            self.assertEqual([i['name'] for i in response.json['data']], names[:2])
+            self.assertEqual(response.json['data'][0]['inn'], u'paracetamol')
+            self.assertGreater(response.json['data'][0]['score'], response.json['data'][1]['score'])
+
+            response = self.app.get(request_path, {'q': 'Paracetamole', 'limit': 1}, status=200)
+            self.assertEqual([i['name'] for i in response.json['data']], names[:1])
+
+            response = self.app.get(request_path, {'q': u'ацетилцестеїн'.encode('utf-8')}, status=200)
+            self.assertEqual([i['name'] for i in response.json['data']], names[4:])
+
+            response = self.app.get(request_path, {'q': 'xyz'}, status=200)
+            self.assertEqual(response.json['data'], [])
+
+        check()
+
+        # same search over the trigram index written by the bridge into the mapped snapshot
+        write_snapshot(config.get('snapshot_path'), generation, values, indexes=search_indexes(values))
+
+        with patch.object(self.app.app.registry.indexes, 'get') as get:
+            check()
+            self.assertFalse(get.called)
+
+        self.app.get(request_path, {'q': 'a', 'limit': 101}, status=422)
+
+    def test_registry_atc_tree(self):
+        request_path = '{}/registry/atc-tree/'.format(ROUTE_PREFIX)
+        self.app.get(request_path + 'N02', status=403)
+        self.app.authorization = ('Basic', ('brokername', 'brokername'))
+        self.app.get(request_path + 'N02', status=404)
+
+        values = {'atc2inn': {'data': {
+            u'N02BE01': [u'paracetamol'], u'N02BE51': [u'paracetamol, combinations'],
+            u'N02BB02': [u'metamizole sodium'], u'R05CB01': [u'acetylcysteine']
+        }}}
+        # ATC code without INNs is only in the atc dictionary
+        values['atc'] = {'data': dict({code: code for code in values['atc2inn']['data']}, A01AA01=u'A01AA01')}
+        generation = self.db.publish(values)
+
+        def check():
+            response = self.app.get(request_path + 'n02b', status=200)
+            self.assertEqual(response.headers['X-Registry-Generation'], str(generation))
+            self.assertEqual(response.json, {'data': {u'N02B': {
+                'children': [u'N02BB', u'N02BE'],
+                'descendants': [u'N02BB', u'N02BB02', u'N02BE', u'N02BE01', u'N02BE51'],
+                'inns': [u'metamizole sodium', u'paracetamol', u'paracetamol, combinations']
+            }}})
+
+            response = self.app.get(request_path, status=200)
+            self.assertEqual(response.json['data'][u'']['children'], [u'A', u'N', u'R'])
+            self.assertEqual(len(response.json['data'][u'']['inns']), 4)
+
+            response = self.app.get(request_path + 'A01', status=200)
+            self.assertEqual(response.json['data'][u'A01'], {
+                'children': [u'A01A'], 'descendants': [u'A01A', u'A01AA', u'A01AA01'], 'inns': []
+            })
+
+            response = self.app.get(request_path + 'R05CB01', status=200)
+            self.assertEqual(response.json['data'][u'R05CB01'], {
+                'children': [], 'descendants': [], 'inns': [u'acetylcysteine']
+            })
+
+            response = self.app.get(request_path + 'J01', status=404)
+            self.assertEqual(response.json['errors'][0]['name'], 'code')
+
+        check()
+
+        # same tree precomputed by the bridge in the mapped snapshot
+        write_snapshot(config.get('snapshot_path'), generation, values, indexes=search_indexes(values))
+
+        with patch.object(self.app.app.registry.indexes, 'get') as get:
+            check()
+            self.assertFalse(get.called)
 
     def test_registry_invalid_api_version(self):
         for param in self.valid_params:
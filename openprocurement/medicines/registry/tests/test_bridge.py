@@ -20,10 +20,10 @@ class TestBridgeWorker(BaseServersTest):
         self.assertEqual(self.worker.delay, config.get('delay'))
         self.assertTrue(isinstance(self.worker.proxy_client, ProxyClient))
         self.assertTrue(self.worker.services_not_available.is_set())
-        self.assertEqual(self.worker.db.backend, 'redis')
-        self.assertEqual(self.worker.db.db_name, 0)
-        self.assertEqual(self.worker.db.port, '6379')
-        self.assertEqual(self.worker.db.host, '127.0.0.1')
+        self.assertEqual(self.worker.db.backend, 'local')
+        self.assertEqual(self.worker.db.db_name, config.get('cache_path'))
+        self.assertIsNone(self.worker.db.port)
+        self.assertIsNone(self.worker.db.host)
 
     def test_start_jobs(self):
         self.worker = MedicinesRegistryBridge(config)
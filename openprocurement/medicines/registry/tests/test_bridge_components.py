@@ -1,14 +1,42 @@
 import os
-
+import sys
+import json
+import socket
+import subprocess
+
+from StringIO import StringIO
+from mimetools import Message
+from urllib import addinfourl
+from urllib2 import HTTPError
 from mock import MagicMock, patch
 
 from openprocurement.medicines.registry.tests.base import BaseServersTest, config
 from openprocurement.medicines.registry.databridge.components import Registry, JsonFormer
+from openprocurement.medicines.registry.databridge.caching import CACHE_REFRESH_AHEAD, payload_key
+from openprocurement.medicines.registry.databridge.extractor import MODULE
+from openprocurement.medicines.registry.databridge.mapped_snapshot import MappedSnapshot
+from openprocurement.medicines.registry.databridge.indexes import TRIGRAMS_SECTION, ATC_TREE_SECTION
 from openprocurement.medicines.registry.utils import (
-    file_is_empty, file_exists, string_time_to_datetime, get_now, create_file, str_to_obj
+    file_is_empty, file_exists, string_time_to_datetime, get_now, create_file, XMLParser
 )
 
 
+class InterruptedStream(StringIO):
+    def __init__(self, body, limit):
+        StringIO.__init__(self, body)
+        self.limit = limit
+
+    def read(self, n=-1):
+        if self.tell() >= self.limit:
+            raise socket.timeout('timed out')
+        return StringIO.read(self, min(n, self.limit - self.tell()))
+
+
+def registry_response(body, headers='', code=200, limit=None):
+    stream = InterruptedStream(body, limit) if limit else StringIO(body)
+    return addinfourl(stream, Message(StringIO(headers)), 'http://registry', code)
+
+
 class TestRegistry(BaseServersTest):
     __test__ = True
 
@@ -33,7 +61,8 @@ class TestRegistry(BaseServersTest):
         with self.assertRaises(AttributeError):
             jobs = self.worker.jobs
 
-    def test_get_registry(self):
+    @patch('retrying.time.sleep')
+    def test_get_registry(self, retry_sleep):
         self.worker = Registry(
             config.get('source_registry'), config.get('time_update_at'), config.get('delay'),
             config.get('registry_delay'), config.get('services_not_available')
@@ -50,18 +79,137 @@ class TestRegistry(BaseServersTest):
         self.worker.get_registry()
         self.assertFalse(file_is_empty(os.path.join(self.worker.DATA_PATH, 'registry.xml')))
 
-    def test_save_registry(self):
+    def test_get_registry_streaming(self):
         self.worker = Registry(
             config.get('source_registry'), config.get('time_update_at'), config.get('delay'),
             config.get('registry_delay'), config.get('services_not_available')
         )
+        self.worker.DATA_PATH = self.DATA_PATH
+        self.worker.source_registry = 'http://registry'
+        self.worker.chunk_size = 16
+
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read()
+
+        response = registry_response('\n' + xml.decode('utf-8').encode('cp1251'))
+        self.worker.urlopen = MagicMock(return_value=response)
+
+        registry_xml = os.path.join(self.worker.DATA_PATH, 'registry.xml')
+        self.assertEqual(self.worker.get_registry(), registry_xml)
+        self.assertFalse(file_exists('{}.tmp'.format(registry_xml)))
+
+        with open(registry_xml, 'r') as f:
+            self.assertEqual(f.read(), xml)
 
+        response = registry_response('<doc-list><doc>'.encode('cp1251'))
+        self.worker.urlopen = MagicMock(return_value=response)
+
+        self.assertIsNone(self.worker.get_registry())
+        self.assertFalse(file_exists('{}.tmp'.format(registry_xml)))
+
+        with open(registry_xml, 'r') as f:
+            self.assertEqual(f.read(), xml)
+
+    def test_get_registry_not_modified(self):
+        self.worker = Registry(
+            config.get('source_registry'), config.get('time_update_at'), config.get('delay'),
+            config.get('registry_delay'), config.get('services_not_available')
+        )
         self.worker.DATA_PATH = self.DATA_PATH
-        self.assertTrue(file_exists(os.path.join(self.worker.DATA_PATH, 'registry.xml')))
-        self.assertTrue(file_is_empty(os.path.join(self.worker.DATA_PATH, 'registry.xml')))
+        self.worker.source_registry = 'http://registry'
 
-        self.worker.save_registry('<?xml version="1.0" encoding="Windows-1251"?>')
-        self.assertFalse(file_is_empty(os.path.join(self.worker.DATA_PATH, 'registry.xml')))
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read()
+
+        headers = 'ETag: "v1"\r\nLast-Modified: Mon, 01 Jan 2018 05:00:00 GMT\r\n\r\n'
+        self.worker.urlopen = MagicMock(return_value=registry_response(xml.decode('utf-8').encode('cp1251'), headers))
+        self.worker.get_registry()
+
+        request = self.worker.urlopen.call_args[0][0]
+        self.assertFalse(request.has_header('If-none-match'))
+        meta = self.worker.read_registry_meta()
+        self.assertEqual(meta['etag'], u'"v1"')
+        self.assertEqual(meta['last_modified'], u'Mon, 01 Jan 2018 05:00:00 GMT')
+
+        registry_xml = os.path.join(self.worker.DATA_PATH, 'registry.xml')
+        last_modified = os.path.getmtime(registry_xml)
+        self.worker.urlopen = MagicMock(
+            side_effect=HTTPError('http://registry', 304, 'Not Modified', Message(StringIO('')), None)
+        )
+        self.assertIsNone(self.worker.get_registry())
+
+        request = self.worker.urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertEqual(request.get_header('If-modified-since'), 'Mon, 01 Jan 2018 05:00:00 GMT')
+        self.assertEqual(os.path.getmtime(registry_xml), last_modified)
+
+    def test_get_registry_same_content(self):
+        self.worker = Registry(
+            config.get('source_registry'), config.get('time_update_at'), config.get('delay'),
+            config.get('registry_delay'), config.get('services_not_available')
+        )
+        self.worker.DATA_PATH = self.DATA_PATH
+        self.worker.source_registry = 'http://registry'
+
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read().decode('utf-8').encode('cp1251')
+
+        registry_xml = os.path.join(self.worker.DATA_PATH, 'registry.xml')
+        self.worker.urlopen = MagicMock(return_value=registry_response(xml, 'ETag: "v1"\r\n\r\n'))
+        self.assertEqual(self.worker.get_registry(), registry_xml)
+        digest = self.worker.read_registry_meta()['sha256']
+        self.assertEqual(len(digest), 64)
+
+        with patch('openprocurement.medicines.registry.databridge.components.xml_file_valid') as xml_file_valid:
+            self.worker.urlopen = MagicMock(return_value=registry_response(xml, 'ETag: "v2"\r\n\r\n'))
+            self.assertIsNone(self.worker.get_registry())
+            self.assertFalse(xml_file_valid.called)
+
+        self.assertFalse(file_exists('{}.tmp'.format(registry_xml)))
+        self.assertEqual(self.worker.read_registry_meta(), {u'etag': u'"v2"', u'last_modified': None, u'sha256': digest})
+
+    @patch('retrying.time.sleep')
+    def test_get_registry_resume(self, retry_sleep):
+        self.worker = Registry(
+            config.get('source_registry'), config.get('time_update_at'), config.get('delay'),
+            config.get('registry_delay'), config.get('services_not_available'), download_retries=2
+        )
+        self.worker.DATA_PATH = self.DATA_PATH
+        self.worker.source_registry = 'http://registry'
+        self.worker.chunk_size = 16
+
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read()
+
+        body = xml.decode('utf-8').encode('cp1251')
+        self.worker.urlopen = MagicMock(side_effect=[
+            registry_response(body, 'ETag: "v1"\r\n\r\n', limit=100),
+            registry_response(body[100:], 'ETag: "v1"\r\n\r\n', code=206)
+        ])
+
+        registry_xml = os.path.join(self.worker.DATA_PATH, 'registry.xml')
+        self.assertEqual(self.worker.get_registry(), registry_xml)
+        self.assertEqual(self.worker.urlopen.call_count, 2)
+        self.assertEqual(retry_sleep.call_count, 1)
+
+        request = self.worker.urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('Range'), 'bytes=100-')
+        self.assertEqual(request.get_header('If-range'), '"v1"')
+        self.assertEqual(self.worker.urlopen.call_args[1], {'timeout': self.worker.read_timeout})
+        self.assertFalse(file_exists('{}.tmp.state'.format(registry_xml)))
+
+        with open(registry_xml, 'r') as f:
+            self.assertEqual(f.read(), xml)
+
+        # connection keeps failing, partial file is kept for the next attempt
+        os.remove(registry_xml)
+        create_file(registry_xml)
+        self.worker.urlopen = MagicMock(side_effect=[
+            registry_response(body, limit=100), registry_response(body[100:], limit=10, code=206)
+        ])
+        self.assertIsNone(self.worker.get_registry())
+        self.assertTrue(file_is_empty(registry_xml))
+        self.assertEqual(self.worker.read_download_state('{}.tmp'.format(registry_xml))['offset'], 110)
 
     def test_registry_update_time(self):
         self.worker = Registry(
@@ -204,33 +352,197 @@ class TestJsonFormer(BaseServersTest):
         self.assertFalse(file_is_empty(self.worker.atc2inn_json))
 
         # check cache
-        cache = self.db.get('inn')
-        self.assertEqual(str_to_obj(cache).get('data'), {u'methyluracil': u'Methyluracil'})
+        cache = self.db.get_payload('inn')
+        self.assertEqual(cache.get('data'), {u'methyluracil': u'Methyluracil'})
 
-        cache = self.db.get('atc')
-        self.assertEqual(str_to_obj(cache).get('data'), {})
+        cache = self.db.get_payload('atc')
+        self.assertEqual(cache.get('data'), {})
 
-        cache = self.db.get('inn2atc')
-        self.assertIn(u'methyluracil', str_to_obj(cache).get('data'))
+        cache = self.db.get_payload('inn2atc')
+        self.assertIn(u'methyluracil', cache.get('data'))
+        self.assertEqual(self.db.get_entry('inn2atc', u'methyluracil'), cache['data'][u'methyluracil'])
+        self.assertEqual(self.db.get_entry('inn', u'methyluracil'), u'Methyluracil')
 
         if file_is_empty(self.worker.atc2inn_json):
-            cache = self.db.get('atc2inn')
-            self.assertEqual(str_to_obj(cache).get('data'), {})
+            cache = self.db.get_payload('atc2inn')
+            self.assertEqual(cache.get('data'), {})
         else:
-            cache = self.db.get('atc2inn')
+            cache = self.db.get_payload('atc2inn')
             with open(self.worker.atc2inn_json) as f:
                 data = f.read()
 
-            if str_to_obj(data).get('data'):
-                self.assertEqual(str_to_obj(data).get('data'), str_to_obj(cache).get('data'))
+            if json.loads(data).get('data'):
+                self.assertEqual(json.loads(data).get('data'), cache.get('data'))
             else:
-                self.assertEqual(str_to_obj(data).get('data'), dict())
+                self.assertEqual(json.loads(data).get('data'), dict())
 
         self.db.flushall()
-        self.assertEqual(self.db.has('inn'), False)
+        self.assertEqual(self.db.published('inn'), False)
+
+        self.worker._update_cache()
+        self.assertEqual(self.db.published('inn'), True)
+        self.assertEqual(self.db.published('atc2inn'), not file_is_empty(self.worker.atc2inn_json))
+
+    def test_cache_monitoring(self):
+        self.worker = JsonFormer(
+            self.db, config.get('delay'), config.get('json_files_delay'),
+            config.get('cache_monitoring_delay'), config.get('services_not_available')
+        )
+        self.worker._update_cache = MagicMock()
+        values = {name: {'data': {}} for name in self.worker.eq_valid_names.values()}
+
+        def monitor():
+            with patch('gevent.sleep', side_effect=[None, StopIteration]):
+                with self.assertRaises(StopIteration):
+                    self.worker.cache_monitoring()
+
+        # nothing published
+        monitor()
+        self.assertEqual(self.worker._update_cache.call_count, 1)
+
+        # published and far from expiry, only O(1) commands are used
+        self.db.publish(values)
+
+        with patch.object(self.db.db, 'keys') as keys:
+            monitor()
+            self.assertFalse(keys.called)
+        self.assertEqual(self.worker._update_cache.call_count, 1)
+
+        # one dictionary missing from the published generation
+        self.db.remove(payload_key('inn', self.db.generation()))
+        monitor()
+        self.assertEqual(self.worker._update_cache.call_count, 2)
+
+        # published generation is about to expire, its TTL is extended instead of republishing
+        generation = self.db.publish(values, ex=CACHE_REFRESH_AHEAD - 1)
+        monitor()
+        self.assertEqual(self.worker._update_cache.call_count, 2)
+        self.assertEqual(self.db.generation(), generation)
+        self.assertGreater(self.db.generation_ttl(), CACHE_REFRESH_AHEAD)
+        self.assertGreater(self.db.db.ttl(payload_key('inn', generation)), CACHE_REFRESH_AHEAD)
+
+    def test_update_snapshot(self):
+        self.worker = JsonFormer(
+            self.db, config.get('delay'), config.get('json_files_delay'),
+            config.get('cache_monitoring_delay'), config.get('services_not_available'),
+            snapshot_path=os.path.join(self.DATA_PATH, 'registry.snapshot')
+        )
+        self.worker.DATA_PATH = self.DATA_PATH
+        data = {'data': {u'methyluracil': u'Methyluracil'}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+
+        for name in self.worker.eq_valid_names.values():
+            with open(os.path.join(self.DATA_PATH, '{}.json'.format(name)), 'w') as f:
+                f.write(json.dumps(data))
+
+        self.worker._update_cache()
+        mapped = MappedSnapshot(self.worker.snapshot_path)
+        generation, snapshot = mapped.get('inn')
+        self.assertEqual(generation, self.db.generation())
+        self.assertEqual(json.loads(str(snapshot.body)), data)
+        self.assertEqual(mapped.lookup('atc2inn', u'methyluracil'), u'Methyluracil')
+        self.assertEqual(mapped.lookup(TRIGRAMS_SECTION, u'  m'), [u'methyluracil'])
+        self.assertIn(u'methyluracil', mapped.lookup(ATC_TREE_SECTION, u'')['descendants'])
+
+        # stale snapshot is removed when a new one can not be written
+        with patch('openprocurement.medicines.registry.databridge.components.write_snapshot', side_effect=OSError):
+            self.worker._update_cache()
+        self.assertFalse(file_exists(self.worker.snapshot_path))
+        self.assertGreater(self.db.generation(), generation)
+
+        # worker process builds the indexes and writes the snapshot off the bridge process
+        self.worker.extract_in_subprocess = True
+
+        with patch('openprocurement.medicines.registry.databridge.components.search_indexes') as indexes:
+            self.worker._update_cache()
+        self.assertFalse(indexes.called)
+        mapped = MappedSnapshot(self.worker.snapshot_path)
+        generation, snapshot = mapped.get('inn')
+        self.assertEqual(generation, self.db.generation())
+        self.assertEqual(json.loads(str(snapshot.body)), data)
+        self.assertEqual(mapped.lookup(TRIGRAMS_SECTION, u'  m'), [u'methyluracil'])
+        self.assertIsNone(mapped.get(ATC_TREE_SECTION)[1])
+
+        self.worker.snapshot_path = os.path.join(self.DATA_PATH, 'missing', 'registry.snapshot')
+        self.worker._update_cache()
+        self.assertFalse(file_exists(self.worker.snapshot_path))
+
+    def test_update_json_files_single_parse(self):
+        self.worker = JsonFormer(
+            self.db, config.get('delay'), config.get('json_files_delay'),
+            config.get('cache_monitoring_delay'), config.get('services_not_available')
+        )
+
+        self.worker.DATA_PATH = self.DATA_PATH
+        self.worker.registry_xml = os.path.join(self.worker.DATA_PATH, 'registry.xml')
+        self.worker.inn_json = os.path.join(self.worker.DATA_PATH, 'inn.json')
+        self.worker.atc_json = os.path.join(self.worker.DATA_PATH, 'atc.json')
+        self.worker.inn2atc_json = os.path.join(self.worker.DATA_PATH, 'inn2atc.json')
+        self.worker.atc2inn_json = os.path.join(self.worker.DATA_PATH, 'atc2inn.json')
+
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read()
+
+        with open(self.worker.registry_xml, 'w') as f:
+            f.write(xml)
+
+        json_files = (self.worker.inn_json, self.worker.atc_json, self.worker.inn2atc_json, self.worker.atc2inn_json)
+
+        for file_path in json_files:
+            create_file(file_path)
+
+        with patch('openprocurement.medicines.registry.databridge.extractor.XMLParser', wraps=XMLParser) as parser:
+            with patch('gevent.sleep', side_effect=StopIteration):
+                with self.assertRaises(StopIteration):
+                    self.worker.update_json_files()
+
+        self.assertEqual(parser.call_count, 1)
+
+        for file_path in json_files:
+            self.assertFalse(file_is_empty(file_path))
+
+    def test_extract_in_subprocess(self):
+        self.worker = JsonFormer(
+            self.db, config.get('delay'), config.get('json_files_delay'),
+            config.get('cache_monitoring_delay'), config.get('services_not_available')
+        )
+        self.worker.registry_xml = os.path.join(self.BASE_DIR, 'test_registry.xml')
+        values = self.worker.extract_values()
+
+        self.worker.extract_in_subprocess = True
+        self.assertEqual(self.worker.extract_values(), values)
+
+        self.worker.registry_xml = os.path.join(self.DATA_PATH, 'registry.xml')
+        self.assertIsNone(self.worker.extract_values())
+
+        self.worker.registry_xml = os.path.join(self.DATA_PATH, 'missing.xml')
+        self.assertIsNone(self.worker.extract_values())
+
+    def test_extract_in_subprocess_isolated_interpreter(self):
+        self.worker = JsonFormer(
+            self.db, config.get('delay'), config.get('json_files_delay'),
+            config.get('cache_monitoring_delay'), config.get('services_not_available'),
+            extract_in_subprocess=True
+        )
+        self.worker.registry_xml = os.path.join(self.BASE_DIR, 'test_registry.xml')
+
+        # like a buildout script: the package is importable only through the parent's in-process sys.path
+        interpreter = os.path.join(self.DATA_PATH, 'python')
+
+        with open(interpreter, 'w') as f:
+            f.write('#!/bin/sh\ncd / && exec {} "$@"\n'.format(sys.executable))
+        os.chmod(interpreter, 0o755)
+
+        env = dict(os.environ)
+        env.pop('PYTHONPATH', None)
+
+        if subprocess.call([interpreter, '-c', 'import {}'.format(MODULE)], env=env, stderr=open(os.devnull, 'w')) == 0:
+            self.skipTest('Package is importable from a bare interpreter')
+
+        with patch('openprocurement.medicines.registry.databridge.extractor.sys.executable', interpreter):
+            values = self.worker.extract_values()
 
-        self.worker._update_cache('inn')
-        self.assertEqual(self.db.has('inn'), True)
+        self.assertEqual(sorted(values), ['atc1', 'atc2inn', 'inn2atc', 'mnn'])
+        self.assertTrue(values['mnn'])
 
     @patch('gevent.sleep')
     def test_start_jobs(self, gevent_sleep):
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import zlib
 import subprocess
 import datetime
 
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from StringIO import StringIO
 from pyramid import testing
 from time import sleep
 from redis import StrictRedis
+from mock import patch
 
 from openprocurement.medicines.registry.api.utils import *
 from openprocurement.medicines.registry.utils import (
@@ -16,10 +20,20 @@ from openprocurement.medicines.registry.utils import (
     create_file,
     get_file_last_modified,
     str_to_obj,
-    XMLParser
+    XMLParser,
+    ElementTreeBackend,
+    LxmlBackend,
+    etree
 )
 from openprocurement.medicines.registry import BASE_DIR
-from openprocurement.medicines.registry.databridge.caching import DB
+from openprocurement.medicines.registry.databridge.caching import (
+    DB, GENERATION_CHANNEL, PAYLOAD_JSON, PAYLOAD_GZIP, PAYLOAD_CHUNKED, PAYLOAD_HASHED, ENTRIES_BATCH,
+    ENTRIES_BUCKETS, GENERATION_GRACE, entries_key, entries_bucket, payload_key, chunk_key, payload_gzip
+)
+from openprocurement.medicines.registry.databridge.mapped_snapshot import write_snapshot, MappedSnapshot
+from openprocurement.medicines.registry.databridge.indexes import (
+    trigrams, build_trigrams, rank, atc_path, build_atc_tree
+)
 from openprocurement.medicines.registry.tests.utils import rm_dir
 
 
@@ -92,6 +106,379 @@ class TestUtils(TestCase):
         self.db.remove('key')
         self.assertIsNone(self.db.get('key'))
 
+    def test_db_payload(self):
+        self.assertIsNone(self.db.get_payload('inn'))
+        self.assertIsNone(self.db.get_payload_body('inn'))
+
+        data = {'data': {u'ацетилцистеїн': u'Ацетилцистеїн'}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        self.db.put_payload('inn', data)
+        self.assertTrue(self.db.get('inn').startswith(PAYLOAD_JSON))
+        self.assertEqual(self.db.get_payload('inn'), data)
+        self.assertEqual(json.loads(self.db.get_payload_body('inn')), data)
+
+        # legacy str(dict) values are still readable
+        self.db.put('inn', data)
+        self.assertEqual(self.db.get_payload('inn'), data)
+        self.assertEqual(json.loads(self.db.get_payload_body('inn')), data)
+
+    def test_db_entries(self):
+        self.assertIsNone(self.db.get_entry('inn2atc', u'methyluracil'))
+        self.assertEqual(self.db.get_entries('inn2atc', [u'methyluracil']), {})
+
+        entries = {u'inn{}'.format(i): [u'A{:02d}'.format(i % 100)] for i in range(ENTRIES_BATCH * 2 + 1)}
+        entries[u'ацетилцистеїн'] = [u'R05CB01']
+        generation = self.db.publish({'inn2atc': {'data': entries}})
+
+        buckets = [entries_key('inn2atc', generation, bucket) for bucket in range(ENTRIES_BUCKETS)]
+        self.assertEqual(sum(self.redis.hlen(key) for key in buckets), len(entries))
+        self.assertTrue(all(0 < self.redis.hlen(key) < len(entries) for key in buckets))
+        self.assertTrue(all(self.redis.ttl(key) > 0 for key in buckets))
+        self.assertEqual(self.db.get_entry('inn2atc', u'ацетилцистеїн'), [u'R05CB01'])
+        self.assertEqual(
+            self.db.get_entries('inn2atc', [u'inn1', u'inn2', u'missing']),
+            {u'inn1': [u'A01'], u'inn2': [u'A02']}
+        )
+        self.assertEqual(self.db.get_entries('inn2atc', []), {})
+
+        with patch.object(self.db.db, 'pipeline', wraps=self.db.db.pipeline) as pipeline:
+            self.assertEqual(
+                self.db.get_entries_multi({'inn2atc': [u'inn1', u'missing'], 'atc2inn': [u'A01']}, generation),
+                {'inn2atc': {u'inn1': [u'A01']}, 'atc2inn': {}}
+            )
+            self.assertEqual(pipeline.call_count, 1)
+
+        self.db.publish({'inn2atc': {'data': {u'inn1': [u'B01']}}})
+        self.assertEqual(self.db.get_entry('inn2atc', u'inn1'), [u'B01'])
+        self.assertIsNone(self.db.get_entry('inn2atc', u'inn2'))
+
+    def test_db_publish(self):
+        self.assertFalse(self.db.published('inn'))
+        self.assertIsNone(self.db.generation())
+
+        first = {
+            'inn': {'data': {u'methyluracil': u'Methyluracil'}, 'dateModified': '2018-01-01 00:00:00+02:00'},
+            'inn2atc': {'data': {u'methyluracil': [u'D03AX']}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        }
+        generation = self.db.publish(first)
+        self.assertTrue(self.db.published('inn'))
+        self.assertTrue(self.db.published('inn2atc'))
+        self.assertFalse(self.db.published('atc'))
+        self.assertEqual(self.db.generation(), generation)
+        self.assertEqual(self.db.get_payload('inn'), first['inn'])
+        self.assertEqual(self.db.get_payload('inn2atc'), first['inn2atc'])
+
+        second = {
+            'inn': {'data': {u'paracetamol': u'Paracetamol'}, 'dateModified': '2018-01-02 00:00:00+02:00'},
+            'inn2atc': {'data': {u'paracetamol': [u'N02BE01']}, 'dateModified': '2018-01-02 00:00:00+02:00'}
+        }
+        next_generation = self.db.publish(second)
+        self.assertGreater(next_generation, generation)
+        self.assertEqual(self.db.get_payload('inn'), second['inn'])
+        self.assertEqual(self.db.get_payload('inn2atc'), second['inn2atc'])
+
+        # superseded generation stays readable for a grace period only
+        self.assertEqual(self.db.get_payload('inn', generation), first['inn'])
+        self.assertEqual(self.db.get_entry('inn2atc', u'methyluracil', generation), [u'D03AX'])
+        self.assertLessEqual(self.redis.ttl(payload_key('inn', generation)), GENERATION_GRACE)
+        self.assertLessEqual(
+            self.redis.ttl(entries_key('inn2atc', generation, entries_bucket(u'methyluracil'))), GENERATION_GRACE
+        )
+        self.assertGreater(self.redis.ttl(payload_key('inn', next_generation)), GENERATION_GRACE)
+
+    def test_db_compressed_payload(self):
+        data = {'data': {u'ацетилцистеїн': u'Ацетилцистеїн'}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        self.db.compression_level = 6
+
+        try:
+            generation = self.db.publish({'inn': data})
+        finally:
+            self.db.compression_level = 0
+
+        payload = self.redis.get(payload_key('inn', generation))
+        self.assertTrue(payload.startswith(PAYLOAD_GZIP))
+        self.assertEqual(self.db.get_payload('inn'), data)
+        self.assertEqual(json.loads(self.db.get_payload_body('inn')), data)
+        self.assertEqual(
+            zlib.decompress(payload_gzip(self.db.get_published('inn')), 16 + zlib.MAX_WBITS),
+            self.db.get_payload_body('inn')
+        )
+        self.assertIsNone(payload_gzip(PAYLOAD_JSON + '{}'))
+
+    def test_db_chunked_payload(self):
+        data = {'data': {u'inn{}'.format(i): [u'A{:02d}'.format(i % 100)] for i in range(100)}}
+
+        with patch('openprocurement.medicines.registry.databridge.caching.PAYLOAD_CHUNK_SIZE', 256):
+            generation = self.db.publish({'inn2atc': data})
+
+        manifest = self.redis.get(payload_key('inn2atc', generation))
+        self.assertTrue(manifest.startswith(PAYLOAD_CHUNKED))
+        chunks = int(manifest[len(PAYLOAD_CHUNKED):])
+        self.assertGreater(chunks, 1)
+        self.assertEqual(self.db.get_payload('inn2atc'), data)
+        self.assertEqual(json.loads(self.db.get_payload_body('inn2atc')), data)
+
+        self.db.publish({'inn2atc': data})
+        self.assertEqual(self.db.get_payload('inn2atc', generation), data)
+        self.assertLessEqual(self.redis.ttl(chunk_key('inn2atc', generation, chunks - 1)), GENERATION_GRACE)
+
+        # a generation with an expired chunk is not served partially
+        self.redis.delete(chunk_key('inn2atc', generation, 0))
+        self.assertIsNone(self.db.get_payload_body('inn2atc', generation))
+
+    def test_db_cluster_nodes(self):
+        db = DB({'app:api': {'cache_nodes': '10.0.0.1:7000, 10.0.0.2:7001 10.0.0.3:7002'}})
+        self.assertEqual(db.cluster_nodes(), [
+            {'host': '10.0.0.1', 'port': '7000'}, {'host': '10.0.0.2', 'port': '7001'},
+            {'host': '10.0.0.3', 'port': '7002'}
+        ])
+
+        legacy = {'node{}_host'.format(i): '10.0.0.{}'.format(i) for i in range(1, 8)}
+        legacy.update({'node{}_port'.format(i): str(7000 + i) for i in range(1, 8)})
+        db = DB({'app:api': legacy})
+        self.assertEqual(db.cluster_nodes(), [
+            {'host': '10.0.0.{}'.format(i), 'port': str(7000 + i)} for i in range(1, 8)
+        ])
+
+    def test_db_subscriber(self):
+        db = DB({'app:api': {'cache_socket_timeout': '0.5', 'cache_socket_connect_timeout': '2'}})
+        self.assertEqual(db.db.connection_pool.connection_kwargs['socket_timeout'], 0.5)
+
+        # a subscription waits for messages longer than any command timeout
+        pubsub = db.subscribe(GENERATION_CHANNEL)
+        self.assertIsNone(pubsub.connection_pool.connection_kwargs['socket_timeout'])
+        self.assertEqual(pubsub.connection_pool.connection_kwargs['socket_connect_timeout'], 2)
+        self.assertIsNot(pubsub.connection_pool, db.db.connection_pool)
+
+    def test_db_touch(self):
+        self.assertIsNone(self.db.touch(['inn']))
+
+        previous = self.db.publish({'inn': {'data': {u'methyluracil': u'Methyluracil'}}}, ex=10)
+        generation = self.db.publish({'inn': {'data': {u'methyluracil': u'Methyluracil'}}}, ex=10)
+        self.assertEqual(self.db.touch(['inn']), generation)
+
+        self.assertGreater(self.redis.ttl('registry:generation'), 10)
+        self.assertGreater(self.redis.ttl(payload_key('inn', generation)), GENERATION_GRACE + 10)
+        self.assertGreater(
+            self.redis.ttl(entries_key('inn', generation, entries_bucket(u'methyluracil'))), GENERATION_GRACE + 10
+        )
+        self.assertLessEqual(self.redis.ttl(payload_key('inn', previous)), GENERATION_GRACE)
+
+    def test_db_scan(self):
+        for i in range(5):
+            self.db.put('inn:{}'.format(i), i)
+        self.db.put('atc:0', 0)
+
+        self.assertEqual(sorted(self.db.scan_iter('inn:*')), ['inn:{}'.format(i) for i in range(5)])
+        self.assertEqual(self.db.keys('atc:*'), ['atc:0'])
+
+        self.db.remove_pattern('inn:*')
+        self.assertEqual(self.db.scan_iter('inn:*'), [])
+        self.assertTrue(self.db.has('atc:0'))
+
+    def test_db_local(self):
+        cache_path = os.path.join(self.DATA_PATH, 'cache')
+        db = DB({'app:api': {'cache_backend': 'local', 'cache_path': cache_path, 'cache_poll_interval': 0.01}})
+        self.assertEqual(db.backend, 'local')
+        self.assertEqual(db.db_name, cache_path)
+
+        self.assertIsNone(db.get('111'))
+        self.assertFalse(db.has('111'))
+        db.put('111', 'test data')
+        self.assertEqual(db.get('111'), 'test data')
+        self.assertTrue(db.has('111'))
+        self.assertEqual(db.keys('11*'), ['111'])
+        db.remove('111')
+        self.assertIsNone(db.get('111'))
+
+        db.put('expired', 'test data', ex=-1)
+        self.assertIsNone(db.get('expired'))
+        self.assertFalse(file_exists(os.path.join(cache_path, 'expired')))
+        self.assertEqual(db.scan_iter('*'), [])
+
+        # another process sees the same store
+        reader = DB({'app:api': {'cache_backend': 'local', 'cache_path': cache_path}})
+        data = {'data': {u'ацетилцистеїн': [u'R05CB01']}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        pubsub = reader.subscribe(GENERATION_CHANNEL)
+        generation = db.publish({'inn2atc': data})
+        self.assertEqual(next(pubsub.listen())['data'], str(generation))
+
+        self.assertEqual(reader.generation(), generation)
+        self.assertEqual(reader.get_payload('inn2atc'), data)
+        self.assertEqual(reader.get_entry('inn2atc', u'ацетилцистеїн'), [u'R05CB01'])
+        self.assertEqual(reader.get_entries('inn2atc', [u'ацетилцистеїн', u'missing']), {u'ацетилцистеїн': [u'R05CB01']})
+        self.assertGreater(reader.generation_ttl(), 0)
+
+        next_generation = db.publish({'inn2atc': data})
+        self.assertEqual(reader.generation(), next_generation)
+        self.assertLessEqual(reader.db.ttl(payload_key('inn2atc', generation)), GENERATION_GRACE)
+
+        # expiry is kept in the file header, checks never load the value
+        with patch('openprocurement.medicines.registry.databridge.local_store.marshal') as marshal:
+            self.assertTrue(reader.published('inn2atc', next_generation))
+            self.assertGreater(reader.generation_ttl(), 0)
+            self.assertTrue(reader.db.expire(payload_key('inn2atc', generation), 1000))
+            self.assertFalse(marshal.load.called)
+
+        self.assertTrue(GENERATION_GRACE < reader.db.ttl(payload_key('inn2atc', generation)) <= 1000)
+        self.assertEqual(reader.get_payload('inn2atc', generation), data)
+        self.assertEqual(db.touch(['inn2atc']), next_generation)
+
+        db.flushall()
+        self.assertIsNone(reader.generation())
+
+    def test_db_local_purge(self):
+        cache_path = os.path.join(self.DATA_PATH, 'cache')
+        db = DB({'app:api': {'cache_backend': 'local', 'cache_path': cache_path}})
+        data = {'data': {u'inn {}'.format(i): [u'A{:02}'.format(i)] for i in range(100)}, 'dateModified': ''}
+        values = {'inn2atc': data, 'atc2inn': data}
+
+        with patch('openprocurement.medicines.registry.databridge.local_store.time') as clock:
+            clock.time.return_value = 1500000000.0
+            db.publish(values)
+            db.publish(values)
+            files = len(os.listdir(cache_path))
+
+            # the previous generation is kept for its grace period, older ones are removed
+            for _ in range(5):
+                clock.time.return_value += GENERATION_GRACE + 1
+                generation = db.publish(values)
+                self.assertEqual(len(os.listdir(cache_path)), files)
+
+            self.assertEqual(db.get_payload('inn2atc'), data)
+            self.assertTrue(db.has(payload_key('inn2atc', generation - 1)))
+            self.assertFalse(file_exists(os.path.join(cache_path, payload_key('inn2atc', generation - 2))))
+
+    def test_db_hashed_payload(self):
+        cache_path = os.path.join(self.DATA_PATH, 'cache')
+        db = DB({'app:api': {'cache_backend': 'local', 'cache_path': cache_path, 'cache_store_payloads': 'false'}})
+        data = {'data': {u'ацетилцистеїн': [u'R05CB01'], u'paracetamol': [u'N02BE01']}, 'dateModified': '2018'}
+        generation = db.publish({'inn2atc': data, 'atc2inn': {'data': {}}})
+
+        # only the hashes hold the entries, the payload is rebuilt from them
+        self.assertTrue(db.get(payload_key('inn2atc', generation)).startswith(PAYLOAD_HASHED))
+        self.assertTrue(db.published('inn2atc'))
+        self.assertEqual(db.get_payload('inn2atc'), data)
+        self.assertEqual(db.get_payload('atc2inn'), {'data': {}})
+        self.assertEqual(db.get_entry('inn2atc', u'paracetamol'), [u'N02BE01'])
+
+        db.compression_level = 6
+        self.assertEqual(json.loads(zlib.decompress(payload_gzip(db.get_published('inn2atc')), 31)), data)
+
+        # incomplete hashes are not served as a payload
+        db.remove(entries_key('inn2atc', generation, entries_bucket(u'paracetamol')))
+        self.assertIsNone(db.get_published('inn2atc'))
+
+    def test_mapped_snapshot(self):
+        snapshot_path = os.path.join(self.DATA_PATH, 'registry.snapshot')
+        mapped = MappedSnapshot(snapshot_path, check_interval=0)
+        self.assertEqual(mapped.get('inn2atc'), (None, None))
+        self.assertIsNone(mapped.lookup('inn2atc', u'ацетилцистеїн'))
+
+        entries = {u'ацетилцистеїн': [u'R05CB01'], u'paracetamol': [u'N02BE01'], u'ambroxol': [u'R05CB06']}
+        values = {
+            'inn2atc': {'data': entries, 'dateModified': '2018-01-01 00:00:00+02:00'},
+            'atc': {'data': {}, 'dateModified': '2018-01-01 00:00:00+02:00'}
+        }
+        write_snapshot(snapshot_path, 7, values, compression_level=6)
+
+        generation, snapshot = mapped.get('inn2atc')
+        self.assertEqual(generation, 7)
+        self.assertEqual(json.loads(str(snapshot.body)), values['inn2atc'])
+        self.assertEqual(json.loads(zlib.decompress(str(snapshot.gzip), 16 + zlib.MAX_WBITS)), values['inn2atc'])
+        self.assertEqual(json.loads(str(mapped.get('atc')[1].body)), values['atc'])
+
+        # bodies are streamed from the mapping, which stays valid for them after a re-mapping
+        with patch('openprocurement.medicines.registry.databridge.mapped_snapshot.BODY_CHUNK_SIZE', 7):
+            chunks = list(snapshot.body)
+        self.assertEqual(len(chunks[0]), 7)
+        self.assertEqual(json.loads(''.join(chunks)), values['inn2atc'])
+        self.assertEqual(len(snapshot.body), len(''.join(chunks)))
+        self.assertEqual(mapped.get('mnn'), (None, None))
+
+        for key, value in entries.items():
+            self.assertEqual(mapped.lookup('inn2atc', key), value)
+        self.assertEqual(mapped.lookup('inn2atc', u'ацетилцистеїн'.encode('utf-8')), [u'R05CB01'])
+        self.assertIsNone(mapped.lookup('inn2atc', u'aspirin'))
+        self.assertIsNone(mapped.lookup('atc', u'J01'))
+        self.assertEqual(mapped.lookup_many('inn2atc', [u'ambroxol', u'aspirin']), {u'ambroxol': [u'R05CB06']})
+        self.assertEqual(mapped.lookup_many('atc', [u'J01']), {})
+        self.assertIsNone(mapped.lookup_many('mnn', [u'J01']))
+        self.assertEqual(mapped.prefix('inn2atc', u'a', 10), [(u'ambroxol', [u'R05CB06'])])
+        self.assertEqual(len(mapped.prefix('inn2atc', u'', 2)), 2)
+        self.assertEqual(mapped.prefix('inn2atc', u'ацетил', 10), [(u'ацетилцистеїн', [u'R05CB01'])])
+        self.assertEqual(mapped.prefix('inn2atc', u'z', 10), [])
+        self.assertIsNone(mapped.prefix('mnn', u'a', 10))
+
+        # new generation replaces the file atomically and is re-mapped by readers
+        pinned = mapped.pin()
+        values['inn2atc']['data'] = {u'paracetamol': [u'N02BE01', u'N02BE51']}
+        write_snapshot(snapshot_path, 8, values)
+        previous, (generation, snapshot) = snapshot, mapped.get('inn2atc')
+        self.assertEqual(generation, 8)
+        self.assertEqual(json.loads(''.join(previous.body))['data'], entries)
+        self.assertIsNone(snapshot.gzip)
+        self.assertEqual(mapped.lookup('inn2atc', u'paracetamol'), [u'N02BE01', u'N02BE51'])
+        self.assertIsNone(mapped.lookup('inn2atc', u'ambroxol'))
+
+        # pinned view keeps reading the mapping it was taken from
+        self.assertEqual(pinned.generation, 7)
+        self.assertEqual(pinned.lookup('inn2atc', u'ambroxol'), [u'R05CB06'])
+        self.assertEqual(pinned.lookup_many('inn2atc', [u'paracetamol']), {u'paracetamol': [u'N02BE01']})
+        self.assertEqual(mapped.pin().generation, 8)
+        self.assertEqual(os.listdir(self.DATA_PATH), ['registry.snapshot'])
+
+        with self.assertRaises(ValueError):
+            write_snapshot(snapshot_path, 9, dict(values, inn2atc_long_section_name=values['atc']))
+        self.assertEqual(mapped.get('inn2atc')[0], 8)
+
+        # index sections are looked up only, no body is written for them
+        write_snapshot(snapshot_path, 9, dict(values, inn_trigrams=values['inn2atc']), compression_level=6)
+        size = os.path.getsize(snapshot_path)
+        write_snapshot(snapshot_path, 9, values, compression_level=6, indexes={'inn_trigrams': values['inn2atc']})
+        self.assertLess(os.path.getsize(snapshot_path), size)
+        self.assertEqual(mapped.lookup('inn_trigrams', u'paracetamol'), [u'N02BE01', u'N02BE51'])
+        self.assertEqual(mapped.get('inn_trigrams'), (None, None))
+        self.assertIsNotNone(mapped.get('inn2atc')[1].gzip)
+
+        # broken or removed file is not served
+        with open(snapshot_path, 'w') as f:
+            f.write('broken')
+        self.assertEqual(mapped.get('inn2atc'), (None, None))
+
+        os.remove(snapshot_path)
+        self.assertEqual(mapped.get('inn2atc'), (None, None))
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams(u'Cat'), {u'  c', u' ca', u'cat', u'at '})
+        self.assertEqual(trigrams(u'a, b'), {u'  a', u' a ', u'  b', u' b '})
+        self.assertEqual(trigrams(u'--'), set())
+
+        index = build_trigrams([u'paracetamol', u'pancreatin', u'metamizole sodium'])
+        self.assertEqual(index[u' pa'], [u'pancreatin', u'paracetamol'])
+        self.assertEqual(index[u'  s'], [u'metamizole sodium'])
+
+        postings = {t: index[t] for t in trigrams(u'paracetamole') if t in index}
+        self.assertEqual([key for _, key in rank(u'paracetamole', postings, 10)], [u'paracetamol'])
+        self.assertEqual(len(rank(u'paracetamole', postings, 10, threshold=0)), 3)
+        self.assertEqual(len(rank(u'paracetamole', postings, 10, candidates=2, threshold=0)), 2)
+        self.assertEqual(len(rank(u'paracetamole', postings, 1, threshold=0)), 1)
+        self.assertEqual(rank(u'paracetamole', {}, 10), [])
+
+    def test_atc_tree(self):
+        self.assertEqual(atc_path(u'A01AA01'), [u'', u'A', u'A01', u'A01A', u'A01AA', u'A01AA01'])
+        self.assertEqual(atc_path(u'J01'), [u'', u'J', u'J01'])
+
+        tree = build_atc_tree({u'A01AA01': [u'sodium fluoride'], u'A01AB': [u'chlorhexidine']}, [u'J01'])
+        self.assertEqual(tree[u'A01'], {
+            'children': [u'A01A'],
+            'descendants': [u'A01A', u'A01AA', u'A01AA01', u'A01AB'],
+            'inns': [u'chlorhexidine', u'sodium fluoride']
+        })
+        self.assertEqual(tree[u'A01A']['children'], [u'A01AA', u'A01AB'])
+        self.assertEqual(tree[u'A01AB'], {'children': [], 'descendants': [], 'inns': [u'chlorhexidine']})
+        self.assertEqual(tree[u'J01'], {'children': [], 'descendants': [], 'inns': []})
+        self.assertEqual(tree[u'']['children'], [u'A', u'J'])
+
     def test_read_user(self):
         with open(os.path.join(BASE_DIR, 'tests/auth.ini'), 'r') as f:
             self.assertEqual(read_users(f), None)
@@ -191,3 +578,103 @@ class TestUtils(TestCase):
         with self.assertRaises(TypeError):
             xml.inn2atc_atc2inn()
 
+    def test_xml_parser_extract(self):
+        with open(os.path.join(self.BASE_DIR, 'test_registry.xml'), 'r') as f:
+            xml = f.read()
+
+        values = XMLParser(xml).extract()
+
+        self.assertEqual(values['mnn'], {u'Methyluracil'})
+        self.assertEqual(values['atc1'], set())
+        self.assertEqual(values['inn2atc'], {u'Methyluracil': set()})
+        self.assertEqual(values['atc2inn'], {})
+
+        xml = XMLParser(
+            '<doc-list><doc><mnn>Ibuprofen*</mnn><atc1>M01AE01</atc1><atc2>M02AA13</atc2><atc3></atc3></doc>'
+            '<doc><mnn>Paracetamol</mnn><atc1>N02BE01</atc1><atc2>M01AE01</atc2><atc3></atc3></doc></doc-list>'
+        )
+        values = xml.extract()
+
+        self.assertEqual(values['mnn'], set(xml.get_values('mnn')))
+        self.assertEqual(values['atc1'], set(xml.get_values('atc1')))
+        self.assertEqual(
+            values['inn2atc'], {k: set(v) for k, v in xml.inn2atc_atc2inn('inn').items()}
+        )
+        self.assertEqual(
+            values['atc2inn'], {k: set(v) for k, v in xml.inn2atc_atc2inn('atc').items()}
+        )
+        self.assertEqual(values['atc2inn'][u'M01AE01'], {u'Ibuprofen', u'Paracetamol'})
+
+        self.assertEqual(XMLParser('').extract(), {'mnn': set(), 'atc1': set(), 'inn2atc': {}, 'atc2inn': {}})
+
+    def test_xml_parser_stream(self):
+        file_path = os.path.join(self.BASE_DIR, 'test_registry.xml')
+
+        with open(file_path, 'r') as f:
+            xml = XMLParser(f.read())
+
+        stream = XMLParser(file_path, stream=True)
+        self.assertIsNone(stream.xml)
+        self.assertEqual(stream.get_values('mnn'), xml.get_values('mnn'))
+        self.assertEqual(XMLParser(file_path, stream=True).extract(), xml.extract())
+        self.assertEqual(XMLParser(file_path, stream=True).inn2atc_atc2inn('inn'), xml.inn2atc_atc2inn('inn'))
+        self.assertTrue(stream.document_valid)
+
+        docs = list(XMLParser(file_path, stream=True).iter_docs())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(len(docs[0]), 0)
+
+        with self.assertRaises(TypeError):
+            XMLParser(1, stream=True)
+
+    def test_xml_parser_stream_invalid(self):
+        file_path = os.path.join(self.DATA_PATH, 'registry.xml')
+
+        with open(file_path, 'w') as f:
+            f.write('<doc-list><doc><mnn>Ibuprofen</mnn></doc><doc><mnn>Paracetamol</mnn>')
+
+        stream = XMLParser(file_path, stream=True)
+        self.assertIsNone(stream.valid)
+        self.assertEqual(stream.extract()['mnn'], {u'Ibuprofen'})
+        self.assertFalse(stream.document_valid)
+
+        create_file(file_path)
+        self.assertFalse(XMLParser(file_path, stream=True).document_valid)
+
+    @skipIf(etree is None, 'lxml is not installed')
+    def test_xml_parser_backends(self):
+        file_path = os.path.join(self.BASE_DIR, 'test_registry.xml')
+
+        with open(file_path, 'r') as f:
+            xml = f.read()
+
+        xml += (
+            '<doc-list><doc><mnn>Ibuprofen*</mnn><atc1>M01AE01</atc1><atc2>M02AA13</atc2><atc3></atc3></doc>'
+            '<!-- comment --><doc><mnn>Paracetamol</mnn><atc1>N02BE01</atc1><atc2>M01AE01</atc2><atc3/></doc></doc-list>'
+        )
+        xml = xml.replace('</doc-list>\n<doc-list>', '')
+
+        for stream in (False, True):
+            source = StringIO(xml) if stream else xml
+            lxml_parser = XMLParser(source, stream=stream, backend=LxmlBackend)
+            source = StringIO(xml) if stream else xml
+            etree_parser = XMLParser(source, stream=stream, backend=ElementTreeBackend)
+
+            self.assertEqual(lxml_parser.extract(), etree_parser.extract())
+            self.assertTrue(lxml_parser.document_valid)
+            self.assertTrue(etree_parser.document_valid)
+
+        lxml_parser = XMLParser(xml, backend=LxmlBackend)
+        etree_parser = XMLParser(xml, backend=ElementTreeBackend)
+
+        for key in ('mnn', 'atc1', 'atc2', 'wrong_key'):
+            self.assertEqual(lxml_parser.get_values(key), etree_parser.get_values(key))
+
+        for root in ('inn', 'atc', 'wrong_root'):
+            self.assertEqual(lxml_parser.inn2atc_atc2inn(root), etree_parser.inn2atc_atc2inn(root))
+
+        self.assertFalse(XMLParser('<doc-list><doc>', backend=LxmlBackend).document_valid)
+        self.assertFalse(XMLParser(StringIO('<doc-list><doc>'), stream=True, backend=LxmlBackend).document_valid)
+
+        with self.assertRaises(TypeError):
+            XMLParser(1, backend=LxmlBackend)
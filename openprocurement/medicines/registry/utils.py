@@ -1,4 +1,5 @@
 import os
+import re
 import ast
 import logging
 from pytz import timezone
@@ -7,7 +8,13 @@ from functools import partial
 
 from xml.etree import ElementTree
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
 logger = logging.getLogger(__name__)
+CHUNK_SIZE = 64 * 1024
 SANDBOX_MODE = True if os.environ.get('SANDBOX_MODE', 'False').lower() == 'true' else False
 TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
 
@@ -43,6 +50,12 @@ def str_to_obj(string):
     return ast.literal_eval(string)
 
 
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
 def get_file_last_modified(filepath):
     if os.path.exists(filepath) and os.path.isfile(filepath):
         return datetime.fromtimestamp(os.path.getmtime(filepath), TZ).replace(microsecond=0)
@@ -72,21 +85,159 @@ def journal_context(record=None, params=None):
     return record
 
 
+class ElementTreeBackend(object):
+    name = 'etree'
+    ParseError = ElementTree.ParseError
+
+    @staticmethod
+    def fromstring(xml):
+        return ElementTree.fromstring(xml, ElementTree.XMLParser(encoding='utf-8'))
+
+    @staticmethod
+    def iterdocs(source, tag):
+        parser = ElementTree.XMLParser(target=ElementTree.TreeBuilder(), encoding='utf-8')
+        root = None
+        depth = 0
+
+        for event, item in ElementTree.iterparse(source, events=('start', 'end'), parser=parser):
+            if event == 'start':
+                root = item if root is None else root
+                depth += 1
+                continue
+
+            depth -= 1
+
+            if depth == 1 and item.tag == tag:
+                yield item
+                item.clear()
+                root.clear()
+
+
+class Utf8Declaration(object):
+    DECLARATION_ENCODING = re.compile(r'^(\s*<\?xml[^>]*?encoding=)(["\'])[^"\']*\2')
+
+    def __init__(self, source):
+        self.source = source
+        self.buffer = None
+
+    def read(self, size=-1):
+        if self.buffer is None:
+            head = self.source.read(size)
+
+            while '?>' not in head and len(head) < 1024:
+                chunk = self.source.read(size)
+
+                if not chunk:
+                    break
+                head += chunk
+
+            self.buffer = self.DECLARATION_ENCODING.sub(r'\1\2utf-8\2', head, count=1)
+
+        if self.buffer:
+            if size < 0:
+                data, self.buffer = self.buffer + self.source.read(), ''
+            else:
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+        return self.source.read(size)
+
+
+class LxmlBackend(object):
+    name = 'lxml'
+    ParseError = etree.XMLSyntaxError if etree is not None else None
+
+    @staticmethod
+    def fromstring(xml):
+        return etree.fromstring(xml, etree.XMLParser(encoding='utf-8', huge_tree=True))
+
+    @staticmethod
+    def iterdocs(source, tag):
+        # libxml2 push parser ignores the encoding override when the prolog declares
+        # another charset and silently stops, so the declaration itself is rewritten
+        if isinstance(source, basestring):
+            with open(source, 'rb') as f:
+                for item in LxmlBackend._iterdocs(Utf8Declaration(f), tag):
+                    yield item
+        else:
+            for item in LxmlBackend._iterdocs(Utf8Declaration(source), tag):
+                yield item
+
+    @staticmethod
+    def _iterdocs(source, tag):
+        for _, item in etree.iterparse(source, events=('end',), tag=tag, huge_tree=True):
+            parent = item.getparent()
+
+            if parent is None or parent.getparent() is not None:
+                continue
+
+            yield item
+            item.clear()
+
+            while item.getprevious() is not None:
+                del parent[0]
+
+
+XML_BACKEND = LxmlBackend if etree is not None else ElementTreeBackend
+
+
+def xml_file_valid(file_path):
+    return XMLParser(file_path, stream=True).document_valid
+
+
 class XMLParser:
-    def __init__(self, xml):
-        parser = ElementTree.XMLParser(encoding='utf-8')
+    def __init__(self, xml, stream=False, backend=None):
+        self.ROOT_ITEM = 'doc'
+        self.stream = stream
+        self.backend = backend or XML_BACKEND
+        self.valid = None
+
+        if stream:
+            if not isinstance(xml, basestring) and not hasattr(xml, 'read'):
+                raise TypeError('Stream source must be a file path or a file object')
+
+            self.source = xml
+            self.xml = None
+            return
+
+        if not isinstance(xml, basestring):
+            raise TypeError('XML document must be a string')
 
         try:
-            self.xml = ElementTree.fromstring(xml, parser)
-        except ElementTree.ParseError as e:
+            self.xml = self.backend.fromstring(xml)
+        except self.backend.ParseError as e:
             logger.exception(e)
             self.xml = None
 
-        self.ROOT_ITEM = 'doc'
+        self.valid = self.xml is not None
 
     @property
     def document_valid(self):
-        return self.xml is not None
+        if self.valid is None:
+            for _ in self.iter_docs():
+                pass
+
+        return self.valid
+
+    def iter_docs(self):
+        if self.stream:
+            return self._iterparse()
+
+        if self.xml is not None:
+            return iter(self.xml.findall(self.ROOT_ITEM))
+
+        return iter(list())
+
+    def _iterparse(self):
+        try:
+            for item in self.backend.iterdocs(self.source, self.ROOT_ITEM):
+                yield item
+        except self.backend.ParseError as e:
+            logger.exception(e)
+            self.valid = False
+            return
+
+        self.valid = True
 
     @staticmethod
     def get_value(key, item):
@@ -100,8 +251,8 @@ class XMLParser:
     def get_values(self, key, unique=True):
         get_value = partial(self.get_value, key)
 
-        if self.xml is not None:
-            values = map(get_value, self.xml.findall(self.ROOT_ITEM))
+        if self.stream or self.xml is not None:
+            values = map(get_value, self.iter_docs())
         else:
             return list()
 
@@ -110,31 +261,52 @@ class XMLParser:
         else:
             return values
 
+    def extract(self):
+        mnn, atc1, inn2atc, atc2inn = set(), set(), dict(), dict()
+
+        for item in self.iter_docs():
+            inn = to_unicode(self.get_value('mnn', item))
+            atc = self.get_value('atc1', item)
+
+            if inn:
+                mnn.add(inn)
+            if atc:
+                atc1.add(to_unicode(atc))
+
+            atc = set([to_unicode(item.findtext(i)) for i in ('atc1', 'atc2', 'atc3') if item.findtext(i)])
+            inn = inn or u''
+
+            inn2atc.setdefault(inn, set()).update(atc)
+
+            for _atc in atc:
+                atc2inn.setdefault(_atc, set()).add(inn)
+
+        return {'mnn': mnn, 'atc1': atc1, 'inn2atc': inn2atc, 'atc2inn': atc2inn}
+
     def inn2atc_atc2inn(self, root):
         _tmp = dict()
 
-        if self.xml is not None:
-            for i in self.xml:
-                inn = i.find('mnn').text or ''
-                atc_list = [i.find('atc1').text, i.find('atc2').text, i.find('atc3').text]
-                atc = set([i.decode('utf-8') for i in atc_list if i])
+        for i in self.iter_docs():
+            inn = i.find('mnn').text or ''
+            atc_list = [i.find('atc1').text, i.find('atc2').text, i.find('atc3').text]
+            atc = set([i.decode('utf-8') for i in atc_list if i])
 
-                inn = inn.replace('*', '').decode('utf-8')
+            inn = inn.replace('*', '').decode('utf-8')
 
-                if root == 'inn':
-                    if inn in _tmp:
-                        value = _tmp.get(inn) | atc
-                        _tmp[inn] = value
-                    else:
-                        _tmp[inn] = atc
-                elif root == 'atc':
-                    for _atc in atc:
-                        if _atc in _tmp:
-                            value = _tmp.get(_atc) | {inn}
-                            _tmp[_atc] = value
-                        else:
-                            _tmp[_atc] = {inn}
+            if root == 'inn':
+                if inn in _tmp:
+                    value = _tmp.get(inn) | atc
+                    _tmp[inn] = value
                 else:
-                    return dict()
+                    _tmp[inn] = atc
+            elif root == 'atc':
+                for _atc in atc:
+                    if _atc in _tmp:
+                        value = _tmp.get(_atc) | {inn}
+                        _tmp[_atc] = value
+                    else:
+                        _tmp[_atc] = {inn}
+            else:
+                return dict()
         return {k: list(v) for k, v in _tmp.items()}
 
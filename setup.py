@@ -31,6 +31,10 @@ api_requires = requires + [
     'pyramid_exclog'
 ]
 
+lxml_requires = [
+    'lxml'
+]
+
 docs_requires = requires + [
     'sphinxcontrib-httpdomain',
 ]
@@ -72,6 +76,7 @@ setup(
         'bot': bridge_requires,
         'test': test_requires,
         'docs': docs_requires,
+        'lxml': lxml_requires,
     },
     entry_points=entry_points
 )